@@ -5,5 +5,8 @@ setup(
     version="1.0.0",
     install_requires=[
         'pyserial'
-    ]
+    ],
+    extras_require={
+        'history': ['numpy']
+    }
 )
@@ -0,0 +1,328 @@
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+from src.Multiwii import MultiwiiSettings
+from src.Multiwii.Multiwii import MultiWii
+from src.RaspberryServer.RaspberryServer import RaspberryServer
+from src.Simulator.MultiwiiSimulator import MultiwiiSimulator
+
+
+# Runs the simulator on its own process, so its CPU time is not accounted to the benchmarked code. The parent asks for
+# the simulator command counters through the pipe.
+
+def serve_simulator(conn, latency, baudrate):
+
+    simulator = MultiwiiSimulator(latency=latency, baudrate=baudrate).start()
+    conn.send(simulator.port)
+
+    while True:
+
+        message = conn.recv()
+
+        if message == 'stats':
+            conn.send(dict(simulator.commands))
+
+        elif message == 'stop':
+            simulator.close()
+            conn.send(None)
+            return
+
+
+def percentile(values, p):
+
+    values = sorted(values)
+
+    if not values:
+        return 0.0
+
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+# Repeatable benchmarks against the local simulator: MSP round trip latency of each getter, achieved telemetry rate of
+# the telemetry loops for several sensor mixes and SET_RC throughput of the RaspberryServer. Times are in
+# milliseconds, cpu is the process CPU time divided by the wall time. Results are saved as JSON to compare commits.
+
+class Benchmark:
+
+    GETTERS = ['attitude', 'altitude', 'raw_imu', 'rc', 'motor', 'servo', 'pid_coef', 'ident', 'status']
+
+    SENSOR_MIXES = {
+        'attitude': [MultiWii.ATTITUDE],
+        'attitude_altitude': [MultiWii.ATTITUDE, MultiWii.ALTITUDE],
+        'imu': [MultiWii.ATTITUDE, MultiWii.ALTITUDE, MultiWii.RAW_IMU],
+        'all': [MultiWii.ALTITUDE, MultiWii.ATTITUDE, MultiWii.RAW_IMU, MultiWii.RC, MultiWii.MOTOR, MultiWii.SERVO],
+    }
+
+    def __init__(self, iterations=500, duration=3.0, latency=0.001, baudrate=115200, server_port=4499,
+                 telemetry_rate=1000):
+
+        self.iterations = iterations
+        self.duration = duration
+        self.latency = latency
+        self.baudrate = baudrate
+        self.server_port = server_port
+        self.telemetry_rate = telemetry_rate
+
+        self.__conn = None
+        self.__process = None
+        self.port = None
+
+    def run(self):
+
+        self.__start_simulator()
+
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = {
+                    'commit': self.__commit(),
+                    'timestamp': time.time(),
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'config': {'iterations': self.iterations, 'duration': self.duration, 'latency': self.latency,
+                               'baudrate': self.baudrate},
+                    'latency': self.bench_latency(),
+                    'telemetry': self.bench_telemetry(),
+                    'server': self.bench_server(),
+                    'server_mixed': self.bench_server(query_every=10),
+                }
+        finally:
+            self.__stop_simulator()
+
+        return results
+
+    # p50/p99 MSP round trip of each getter
+
+    def bench_latency(self):
+
+        results = {}
+        mw = self.__create_multiwii()
+
+        try:
+            for name in self.GETTERS:
+
+                getter = getattr(mw, 'get_' + name)
+                samples = []
+                cpu_start = time.process_time()
+                wall_start = time.perf_counter()
+
+                for _ in range(self.iterations):
+                    start = time.perf_counter()
+                    getter()
+                    samples.append((time.perf_counter() - start) * 1000.0)
+
+                results[name] = self.__summary(samples, cpu_start, wall_start)
+        finally:
+            self.__close_multiwii(mw)
+
+        return results
+
+    # Achieved rate of telemetry_loop and udp_telemetry_loop (one datagram per message, one bundle per tick or one delta
+    # encoded bundle per tick) for each sensor mix, every message of the mix is requested at telemetry_rate (as fast as
+    # possible by default). Overruns are the polls missed because the link was busy.
+
+    def bench_telemetry(self):
+
+        results = {}
+
+        for mix, cmds in sorted(self.SENSOR_MIXES.items()):
+            results[mix] = {'telemetry_loop': self.__bench_telemetry_loop(cmds, False),
+                            'udp_telemetry_loop': self.__bench_telemetry_loop(cmds, True),
+                            'udp_telemetry_bundle': self.__bench_telemetry_loop(cmds, True, True),
+                            'udp_telemetry_delta': self.__bench_telemetry_loop(cmds, True, True, True)}
+
+        return results
+
+    # SET_RC datagrams per second sent to RaspberryServer.start_listening, serial writes per second reaching the
+    # flight controller and time from the reception of each SET_RC to its handling. With query_every an ATTITUDE query
+    # is sent every that many SET_RC, as a ground station mixing control and telemetry would do.
+
+    def bench_server(self, query_every=None):
+
+        mw = self.__create_multiwii()
+        # Each SET_RC is written as it is received, the RC stream would send them at its own fixed rate
+        mw.settings.rc_stream = False
+        server = RaspberryServer('127.0.0.1', self.server_port, mw)
+        server.start_server()
+
+        listener = threading.Thread(target=server.start_listening, daemon=True)
+        listener.start()
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        package = struct.pack('>2h4h', RaspberryServer.SET_RC, 8, 1500, 1500, 1500, 1100)
+        query = struct.pack('>2h', RaspberryServer.ATTITUDE, 0)
+
+        written_before = self.__simulator_stats().get(MultiWii.SET_RAW_RC, 0)
+        sent = 0
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+
+        while time.perf_counter() - wall_start < self.duration:
+            client.sendto(package, server.address)
+            sent += 1
+            if query_every and sent % query_every == 0:
+                client.sendto(query, server.address)
+            # Paces the client as a 1 kHz ground station would at most, to not only measure socket drops
+            time.sleep(0.001)
+
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        time.sleep(0.5)
+        written = self.__simulator_stats().get(MultiWii.SET_RAW_RC, 0) - written_before
+
+        client.sendto(struct.pack('>2h', RaspberryServer.END_CONNECTION, 0), server.address)
+        listener.join(2.0)
+        client.close()
+        self.__close_multiwii(mw)
+
+        dispatch = server.dispatch_stats().get(RaspberryServer.SET_RC, {})
+
+        return {'sent_per_second': sent / wall, 'written_per_second': written / wall,
+                'delivered': float(written) / sent if sent else 0.0, 'cpu': cpu / wall,
+                'dispatch_p50': dispatch.get('p50', 0.0), 'dispatch_p99': dispatch.get('p99', 0.0)}
+
+    def __bench_telemetry_loop(self, cmds, udp, bundle=False, delta=False):
+
+        mw = self.__create_multiwii()
+        mw.settings.telemetry_bundle = bundle
+        mw.settings.telemetry_delta = delta
+        for cmd, flag in MultiWii.TELEMETRY_FLAGS:
+            setattr(mw.settings, flag, cmd in cmds)
+            setattr(mw.settings, flag + '_RATE', self.telemetry_rate)
+
+        receiver = None
+
+        if udp:
+            receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            receiver.bind(('127.0.0.1', 0))
+            loop = threading.Thread(target=mw.udp_telemetry_loop, args=(receiver.getsockname(), ""), daemon=True)
+        else:
+            loop = threading.Thread(target=mw.telemetry_loop, daemon=True)
+
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        loop.start()
+        time.sleep(self.duration)
+        ticks = mw.telemetry_ticks
+        datagrams = mw.datagrams_sent
+        datagram_bytes = mw.datagram_bytes_sent
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        if udp:
+            scheduler = mw.udp_telemetry_scheduler
+            mw.stop_udp_telemetry()
+        else:
+            scheduler = mw.telemetry_scheduler
+            mw.stop_telemetry()
+
+        loop.join(2.0)
+        self.__close_multiwii(mw)
+
+        if receiver is not None:
+            receiver.close()
+
+        return {'hz': ticks / wall, 'messages_per_second': ticks * len(cmds) / wall, 'cpu': cpu / wall,
+                'overruns_per_second': scheduler.total_overruns() / wall, 'datagrams_per_second': datagrams / wall,
+                'bytes_per_second': datagram_bytes / wall}
+
+    def __summary(self, samples, cpu_start, wall_start):
+
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        return {'count': len(samples), 'mean': sum(samples) / len(samples), 'p50': percentile(samples, 50),
+                'p99': percentile(samples, 99), 'max': max(samples), 'cpu': cpu / wall}
+
+    def __create_multiwii(self):
+
+        settings = MultiwiiSettings.Settings(self.port)
+        settings.wakeup = 0
+        # Every getter is a serial round trip, the configuration messages are not cached
+        settings.config_ttl = {}
+
+        return MultiWii(settings)
+
+    @staticmethod
+    def __close_multiwii(mw):
+
+        mw.stop_rc_stream()
+        mw.stop_worker()
+        mw.serial.close()
+
+    def __start_simulator(self):
+
+        self.__conn, child = multiprocessing.Pipe()
+        self.__process = multiprocessing.Process(target=serve_simulator, args=(child, self.latency, self.baudrate),
+                                                 daemon=True)
+        self.__process.start()
+        self.port = self.__conn.recv()
+
+    def __stop_simulator(self):
+
+        self.__conn.send('stop')
+        self.__conn.recv()
+        self.__process.join()
+
+    def __simulator_stats(self):
+
+        self.__conn.send('stats')
+        return self.__conn.recv()
+
+    @staticmethod
+    def __commit():
+
+        try:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return 'unknown'
+
+
+def save(results, path):
+
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path):
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def report(results, prefix=''):
+
+    for key in sorted(results):
+
+        if isinstance(results[key], dict):
+            report(results[key], prefix + key + '.')
+
+        elif isinstance(results[key], float):
+            print('{:<55} {:>12.3f}'.format(prefix + key, results[key]))
+
+
+# Prints every metric of two benchmark runs side by side, with the relative change
+
+def compare(before, after, prefix=''):
+
+    for key in sorted(after):
+
+        if key not in before:
+            continue
+
+        if isinstance(after[key], dict):
+            compare(before[key], after[key], prefix + key + '.')
+
+        elif isinstance(after[key], float) and before[key]:
+            change = (after[key] - before[key]) / before[key] * 100.0
+            print('{:<55} {:>12.3f} {:>12.3f} {:>+8.1f}%'.format(prefix + key, before[key], after[key], change))
@@ -0,0 +1,25 @@
+import argparse
+
+from src.Benchmark import Benchmark
+
+parser = argparse.ArgumentParser(description="MultiWii / RaspberryServer benchmarks against the local simulator")
+parser.add_argument("--output", help="JSON file where the results are saved (default: benchmark-<commit>.json)")
+parser.add_argument("--iterations", type=int, default=500, help="round trips measured per getter")
+parser.add_argument("--duration", type=float, default=3.0, help="seconds each telemetry/server benchmark runs")
+parser.add_argument("--latency", type=float, default=0.001, help="simulator reply latency in seconds")
+parser.add_argument("--baudrate", type=int, default=115200, help="simulator baud rate, 0 for unlimited")
+parser.add_argument("--telemetry-rate", type=float, default=1000, help="rate (Hz) requested for each telemetry message")
+parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two saved results and exit")
+args = parser.parse_args()
+
+if args.compare:
+    Benchmark.compare(Benchmark.load(args.compare[0]), Benchmark.load(args.compare[1]))
+else:
+    benchmark = Benchmark.Benchmark(args.iterations, args.duration, args.latency, args.baudrate or None,
+                                    telemetry_rate=args.telemetry_rate)
+    results = benchmark.run()
+
+    output = args.output or "benchmark-{}.json".format(results["commit"])
+    Benchmark.save(results, output)
+    Benchmark.report(results)
+    print("Results saved to: " + output)
@@ -0,0 +1,379 @@
+import asyncio
+import os
+import time
+
+from collections import deque
+
+from src.Multiwii import MultiwiiSettings, Drone, MspParser, MspMessages, TelemetryScheduler, TelemetryHistory, \
+    LatencyHistogram, Logger, RcStreamer
+from src.Multiwii.Multiwii import MultiWii
+
+log = Logger.get_logger('AsyncMultiWii')
+serial_log = Logger.RateLimitedLogger(log)
+
+
+# asyncio version of the MultiWii. The serial port file descriptor is set as non-blocking and driven by the event loop
+# (add_reader/add_writer), so control, telemetry and several clients can share it from a single thread. Replies are
+# matched to the awaiting requests by their command ID.
+
+class AsyncMultiWii(object):
+
+    def __init__(self, settings=None):
+
+        self.drone = Drone.Drone()
+        self.parser = MspParser.MspParser()
+        self.settings = settings or MultiwiiSettings.Settings()
+        self.serial = self.settings.serial_port
+        self.loop = None
+        # MSP framing, only set by the settings (MSP v1 unless forced to 2)
+        self.msp_version = self.settings.msp_version or 1
+        # Timing of the MSP transactions by command, see MultiWii.latency_stats
+        self.latency = LatencyHistogram.LatencyStats()
+        # Hot path counters, see MultiWii.stats
+        self.bytes_written = 0
+        self.rc_written = 0
+        self.telemetry_ticks = 0
+        self.telemetry_scheduler = None
+        self.rc_streamer = None
+
+        if self.settings.history_capacity:
+            self.drone.history = TelemetryHistory.TelemetryHistory(self.settings.history_capacity)
+        self.fd = None
+
+        self.__pending = {}
+        self.__write_buffer = bytearray()
+
+    # Opens the serial port and registers it on the running event loop
+
+    async def connect(self):
+
+        self.loop = asyncio.get_running_loop()
+
+        try:
+            self.serial.open()
+            self.fd = self.serial.fileno()
+            os.set_blocking(self.fd, False)
+            self.loop.add_reader(self.fd, self.__on_readable)
+        except ValueError as err:
+            log.error('Serial port exception: %s', err)
+
+        await asyncio.sleep(self.settings.wakeup)
+
+    def close(self):
+
+        self.stop_rc_stream()
+
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.fd = None
+            self.serial.close()
+
+        for requests in self.__pending.values():
+            for future, start in requests:
+                if not future.done():
+                    future.cancel()
+        self.__pending.clear()
+
+    # Sends a MSP command without waiting for a reply
+
+    def send_cmd(self, code, data=None):
+
+        payload = MspMessages.encode(code, data) if data else b''
+        self.__write(MspParser.create_frame(code, payload, b'<', self.msp_version))
+
+        if code == MultiWii.SET_RAW_RC:
+            self.rc_written += 1
+
+    # Sends a MSP getter and waits for its reply, returns (total_data, elapsed). Raises asyncio.TimeoutError if the
+    # reply is not received before the MSP timeout.
+
+    async def get_data(self, cmd, timeout=None):
+
+        return (await self.__request([cmd], timeout))[0]
+
+    # Collects several data messages with a single serial write. Returns a dict {cmd: (total_data, elapsed)}, commands
+    # whose reply has not been received are not included.
+
+    async def get_many(self, cmds, timeout=None):
+
+        replies = {}
+        results = await self.__request(cmds, timeout, return_exceptions=True)
+
+        for cmd, result in zip(cmds, results):
+            if isinstance(result, Exception):
+                serial_log.warning('Serial port exception: %s', result)
+            else:
+                replies[cmd] = result
+
+        return replies
+
+    # As MultiWii.set_rc: when rc_stream is enabled on the settings file the values are held by the RC stream and sent
+    # at its rate. Not a coroutine, it never waits, so the server calls it from its datagram callback. Raises
+    # ValueError if a value does not fit an unsigned 16 bits word.
+
+    def set_rc(self, rc_data):
+
+        RcStreamer.check_channels(rc_data)
+
+        if self.settings.rc_stream:
+            self.start_rc_stream().set(rc_data)
+        else:
+            self.send_cmd(MultiWii.SET_RAW_RC, rc_data)
+
+    # The arm/disarm stick sequences are played by the RC stream, as MultiWii.arm/disarm do
+
+    async def arm(self):
+
+        if not self.drone.armed:
+
+            profile = []
+
+            if self.settings.throttle_yaw:
+                profile.append((2.5, [1500, 1500, self.settings.max_yaw, self.settings.min_throttle]))
+
+            if self.settings.throttle_roll:
+                profile.append((2.5, [self.settings.max_roll, 1500, 1500, self.settings.min_throttle]))
+
+            if await self.__play(profile):
+                self.drone.armed = True
+
+    async def disarm(self):
+
+        if self.drone.armed:
+
+            profile = []
+
+            if self.settings.throttle_yaw:
+                profile.append((2.5, [1500, 1500, self.settings.min_yaw, self.settings.min_throttle]))
+
+            if self.settings.throttle_roll:
+                profile.append((2.5, [self.settings.min_roll, 1500, 1500, self.settings.min_throttle]))
+
+            await self.__play(profile)
+
+        self.drone.armed = False
+
+    # Starts the RC stream of the MultiWii (RcStreamer). Its thread hands every RC frame to the event loop, which owns
+    # the serial port.
+
+    def start_rc_stream(self):
+
+        if self.rc_streamer is None:
+            self.rc_streamer = RcStreamer.RcStreamer(self.__send_rc_threadsafe, self.settings.rc_rate,
+                                                     self.settings.rc_hold_timeout)
+            self.rc_streamer.start()
+
+        return self.rc_streamer
+
+    def stop_rc_stream(self):
+
+        if self.rc_streamer is not None:
+            self.rc_streamer.stop()
+            self.rc_streamer = None
+
+    # Same getter selection and rates as the MultiWii telemetry loops
+    telemetry_cmds = MultiWii.telemetry_cmds
+    telemetry_rates = MultiWii.telemetry_rates
+    latency_stats = MultiWii.latency_stats
+
+    # Same counters as MultiWii.stats, there is no serial worker queue: every request is written at once
+
+    def stats(self):
+
+        return {
+            'serial_bytes_in': self.parser.bytes_received,
+            'serial_bytes_out': self.bytes_written,
+            'frames': self.parser.frames,
+            'checksum_errors': self.parser.checksum_errors,
+            'error_frames': self.parser.error_frames,
+            'resync_bytes': self.parser.skipped_bytes,
+            'rc_written': self.rc_written,
+            'datagrams_sent': 0,
+            'telemetry_ticks': self.telemetry_ticks,
+            'telemetry_overruns': self.telemetry_scheduler.total_overruns() if self.telemetry_scheduler else 0,
+            'stale_skipped': 0,
+            'serial_queue': 0,
+            'serial_in_flight': sum(len(requests) for requests in self.__pending.values()),
+            'recorder_dropped': 0,
+        }
+
+    # Async generator that polls a message every period seconds and yields the updated Drone attribute
+
+    async def stream(self, cmd, period=None):
+
+        async for updates in self.telemetry_stream([cmd], period or self.settings.TELEMETRY_TIME):
+            if cmd in updates:
+                yield updates[cmd]
+
+    # Async generator that polls the given messages every period seconds, or by default the ones enabled on the
+    # settings file each one at its own rate, and yields a dict {cmd: Drone attribute} with the updated ones.
+
+    async def telemetry_stream(self, cmds=None, period=None):
+
+        if cmds is None and period is None:
+            rates = self.telemetry_rates()
+        else:
+            rates = dict((cmd, 1.0 / (period or self.settings.TELEMETRY_TIME)) for cmd in cmds or self.telemetry_cmds())
+
+        scheduler = TelemetryScheduler.TelemetryScheduler(rates)
+        self.telemetry_scheduler = scheduler
+
+        while True:
+
+            delay = scheduler.delay()
+
+            if delay is None:
+                # Nothing to poll: waits until the stream is closed, as telemetry_loop waits until it is stopped
+                await asyncio.get_running_loop().create_future()
+
+            await asyncio.sleep(delay)
+
+            updates = {}
+            for cmd, (total_data, elapsed) in (await self.get_many(scheduler.pop_due())).items():
+                message = MspMessages.get(cmd)
+                updates[cmd] = self.drone.update(message, total_data, elapsed)
+
+            self.telemetry_ticks += 1
+            yield updates
+
+    # Requests a getter of the MSP registry, stores its values on the Drone and returns the Drone attribute
+
+    async def get_message(self, cmd, timeout=None):
+
+        message = MspMessages.get(cmd)
+
+        try:
+            total_data, elapsed = await self.get_data(cmd, timeout)
+            self.drone.update(message, total_data, elapsed)
+
+        except (asyncio.TimeoutError, ValueError) as err:
+            serial_log.warning('Serial port exception: %s', err)
+
+        return getattr(self.drone, message.attribute)
+
+    # Getters (get_attitude, get_raw_imu, ...) are generated from the MSP registry as the MultiWii ones
+
+    @staticmethod
+    def _create_getter(message):
+
+        async def getter(self, timeout=None):
+            return await self.get_message(message.code, timeout)
+
+        getter.__name__ = 'get_' + message.name
+
+        return getter
+
+    # Plays a stick profile on the RC stream as MultiWii.__play: the sticks are then held centered with the minimum
+    # throttle if rc_stream is enabled, otherwise the stream is stopped. Returns False if it was not played in time.
+
+    async def __play(self, profile):
+
+        then = [1500, 1500, 1500, self.settings.min_throttle] if self.settings.rc_stream else None
+        done = self.start_rc_stream().play(profile, then)
+        timeout = sum(duration for duration, _ in profile) + MultiWii.PROFILE_MARGIN
+        played = await self.loop.run_in_executor(None, done.wait, timeout)
+
+        if not self.settings.rc_stream:
+            self.stop_rc_stream()
+
+        if not played:
+            log.warning('RC profile not played in time')
+
+        return played
+
+    def __send_rc_threadsafe(self, rc_data):
+
+        self.loop.call_soon_threadsafe(self.send_cmd, MultiWii.SET_RAW_RC, rc_data)
+
+    async def __request(self, cmds, timeout, return_exceptions=False):
+
+        timeout = timeout if timeout is not None else self.settings.msp_timeout
+        package = b''.join(MspParser.create_frame(cmd, b'', b'<', self.msp_version) for cmd in cmds)
+        write_start = time.perf_counter_ns()
+        self.__write(package)
+        # Replies are only read by the event loop, so the requests can be queued after the write
+        times = (write_start, time.perf_counter_ns())
+        requests = []
+
+        for cmd in cmds:
+            request = (self.loop.create_future(), times)
+            self.__pending.setdefault(cmd, deque()).append(request)
+            requests.append((cmd, request))
+
+        return await asyncio.gather(*[self.__wait(cmd, request, timeout) for cmd, request in requests],
+                                    return_exceptions=return_exceptions)
+
+    async def __wait(self, cmd, request, timeout):
+
+        try:
+            return await asyncio.wait_for(request[0], timeout)
+
+        except asyncio.TimeoutError:
+            requests = self.__pending.get(cmd)
+            if requests and request in requests:
+                requests.remove(request)
+            raise asyncio.TimeoutError('MSP timeout waiting for command: ' + str(cmd))
+
+    def __on_readable(self):
+
+        try:
+            chunk = os.read(self.fd, max(self.serial.in_waiting, 64))
+        except BlockingIOError:
+            return
+
+        received = time.perf_counter_ns()
+
+        for frame in self.parser.feed(chunk, received):
+
+            requests = self.__pending.get(frame.cmd)
+
+            while requests:
+                future, (write_start, written) = requests.popleft()
+
+                if future.done():
+                    continue
+
+                self.latency.record(frame.cmd, write_start, written, self.parser.frame_started, received)
+
+                if frame.error:
+                    future.set_exception(ValueError('MSP error reply for command: ' + str(frame.cmd)))
+                else:
+                    future.set_result((MspMessages.decode(frame.cmd, frame.data),
+                                       (received - write_start) / 1000000000.0))
+                break
+
+    # Writes as much as the port accepts, the rest is written by the event loop when the port is writable again
+
+    def __write(self, data):
+
+        self.bytes_written += len(data)
+
+        if self.__write_buffer:
+            self.__write_buffer += data
+            return
+
+        try:
+            written = os.write(self.fd, data)
+        except BlockingIOError:
+            written = 0
+
+        if written < len(data):
+            self.__write_buffer += data[written:]
+            self.loop.add_writer(self.fd, self.__on_writable)
+
+    def __on_writable(self):
+
+        try:
+            written = os.write(self.fd, self.__write_buffer)
+        except BlockingIOError:
+            return
+
+        del self.__write_buffer[:written]
+
+        if not self.__write_buffer:
+            self.loop.remove_writer(self.fd)
+
+
+for _message in MspMessages.GETTERS:
+    setattr(AsyncMultiWii, 'get_' + _message.name, AsyncMultiWii._create_getter(_message))
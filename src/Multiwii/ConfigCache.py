@@ -0,0 +1,62 @@
+import threading
+import time
+
+
+# Caches the replies of the configuration messages (IDENT, PID, RC_TUNING, BOXNAMES, ...), which only change when they
+# are written, so the ground station configuration screens do not take serial time from the telemetry. Each message is
+# kept for its TTL in seconds. Writing a setter invalidates the messages it changes (see MspMessage.invalidates).
+#
+# Every invalidation bumps the generation of the message, and a reply is only stored if the generation has not changed
+# since its request was sent: a reply requested before a setter is not cached after it.
+
+class ConfigCache(object):
+
+    def __init__(self, ttls):
+
+        self.ttls = dict((code, ttl) for code, ttl in ttls.items() if ttl > 0)
+        self.hits = 0
+        self.misses = 0
+
+        self.__replies = {}
+        self.__generations = dict.fromkeys(self.ttls, 0)
+        self.__lock = threading.Lock()
+
+    def __contains__(self, code):
+
+        return code in self.ttls
+
+    # Returns the cached reply (total_data, elapsed) of a message, None if it is not cached or has expired
+
+    def get(self, code):
+
+        entry = self.__replies.get(code)
+
+        if entry is not None and time.monotonic() < entry[1]:
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+
+        return None
+
+    # Generation to give to put() with the reply of a request sent now
+
+    def generation(self, code):
+
+        return self.__generations.get(code)
+
+    def put(self, code, reply, generation):
+
+        with self.__lock:
+            if code in self.ttls and self.__generations[code] == generation:
+                self.__replies[code] = (reply, time.monotonic() + self.ttls[code])
+
+    # Drops the given messages, or every message
+
+    def invalidate(self, codes=None):
+
+        with self.__lock:
+            for code in self.ttls if codes is None else codes:
+                if code in self.ttls:
+                    self.__replies.pop(code, None)
+                    self.__generations[code] += 1
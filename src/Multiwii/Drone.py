@@ -1,14 +1,28 @@
+import time
+
+from src.Multiwii import MspMessages
+
+
 class Drone:
 
     def __init__(self):
         self.armed = False
-        self.attitude = {'angx': 0, 'angy': 0, 'heading': 0, 'elapsed': 0, 'timestamp': 0}
-        self.altitude = {'estalt': 0, 'vario': 0, 'elapsed': 0, 'timestamp': 0}
-        self.PID_coef = {'rp': 0, 'ri': 0, 'rd': 0, 'pp': 0, 'pi': 0, 'pd': 0, 'yp': 0, 'yi': 0, 'yd': 0,
-                         'elapsed': 0, 'timestamp': 0}
-        self.raw_imu = {'accx': 0, 'accy': 0, 'accz': 0, 'gyrx': 0, 'gyry': 0, 'gyrz': 0, 'magx': 0, 'magy': 0,
-                        'magz': 0, 'elapsed': 0, 'timestamp': 0}
-        self.motor = {'m1': 0, 'm2': 0, 'm3': 0, 'm4': 0, 'elapsed': 0, 'timestamp': 0}
-        self.servo = {'s1': 0, 's2': 0, 's3': 0, 's4': 0, 'elapsed': 0, 'timestamp': 0}
-        self.rc_channels = {'roll': 0, 'pitch': 0, 'yaw': 0, 'throttle': 0, 'elapsed': 0, 'timestamp': 0}
+        # TelemetryHistory recording every published snapshot, None to keep only the last one
+        self.history = None
+
+        # One snapshot per MSP getter (attitude, altitude, raw_imu, PID_coef, rc_channels, ...), see MspMessages
+        for message in MspMessages.GETTERS:
+            setattr(self, message.attribute, message.snapshot._make([0] * len(message.snapshot._fields)))
+
+    # Publishes a new snapshot of a MSP message. Snapshots are immutable and replaced with a single reference swap, so
+    # readers on other threads always see a consistent one without locks. Elapsed is the round trip time in seconds.
+
+    def update(self, message, values, elapsed):
+
+        snapshot = message.snapshot._make(values + (int(elapsed * 1000000000), time.monotonic_ns()))
+        setattr(self, message.attribute, snapshot)
+
+        if self.history is not None:
+            self.history.append(message, snapshot)
 
+        return snapshot
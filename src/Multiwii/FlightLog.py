@@ -0,0 +1,230 @@
+import mmap
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from src.Multiwii import MspMessages, FlightRecorder, TelemetryHistory, Logger
+
+log = Logger.get_logger('FlightLog')
+
+# Columns of the record index, sorted by timestamp. Offset is the position of the payload on the log file.
+INDEX_DTYPE = [('timestamp', '<u8'), ('direction', 'u1'), ('code', '<u2'), ('size', '<u2'), ('offset', '<u8')]
+
+
+# Reads a flight log written by the FlightRecorder. The file is memory mapped and only the record headers are scanned
+# once to build the index, which is saved next to the log (<log>.idx.npy) and reused while it still covers the whole
+# file. Messages of a type are decoded in bulk: their payloads are gathered from the mapped file into a single array
+# and viewed with the wire layout of the registry, so hours of telemetry are decoded without a Python loop per frame.
+# Times are the monotonic nanoseconds of the recorder, wall_time() converts them.
+
+class FlightLog(object):
+
+    # Rows decoded at once by messages(), bounds the memory used by the temporary arrays
+    CHUNK = 65536
+
+    def __init__(self, path, save_index=True):
+
+        if numpy is None:
+            raise ImportError("The flight log reader needs numpy: pip install MultiWiiServer[history]")
+
+        self.path = path
+        self.__file = open(path, 'rb')
+        self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.monotonic_ns, self.wall_ns = FlightRecorder.HEADER.unpack_from(self.__map)
+
+        if magic != FlightRecorder.MAGIC:
+            self.close()
+            raise ValueError('Not a MSP flight log: ' + path)
+
+        self.__raw = numpy.frombuffer(self.__map, dtype=numpy.uint8)
+        self.__by_code = {}
+        self.index = self.__load_index()
+
+        if self.index is None:
+            self.index = self.__build_index()
+            if save_index:
+                self.__save_index()
+
+    def __len__(self):
+
+        return len(self.index)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+    def close(self):
+
+        self.__raw = None
+        self.__map.close()
+        self.__file.close()
+
+    # Number of records of each (direction, code)
+
+    def counts(self):
+
+        keys, counts = numpy.unique(self.index['direction'].astype(numpy.uint32) << 16 | self.index['code'],
+                                    return_counts=True)
+
+        return dict(((chr(key >> 16), int(key & 0xFFFF)), int(count)) for key, count in zip(keys, counts))
+
+    # Wall clock time (seconds since the epoch) of a recorder timestamp
+
+    def wall_time(self, timestamp):
+
+        return (self.wall_ns + (int(timestamp) - self.monotonic_ns)) / 1000000000.0
+
+    # Index rows of a command received (or sent, with direction OUT) between t0 and t1 (included)
+
+    def select(self, code=None, t0=None, t1=None, direction=FlightRecorder.IN):
+
+        rows = self.index[self.__positions(code, direction)] if code is not None else self.index
+
+        if t0 is not None or t1 is not None:
+            timestamps = rows['timestamp']
+            start = 0 if t0 is None else numpy.searchsorted(timestamps, t0, 'left')
+            end = len(rows) if t1 is None else numpy.searchsorted(timestamps, t1, 'right')
+            rows = rows[start:end]
+
+        if code is None and direction is not None:
+            rows = rows[rows['direction'] == direction]
+
+        return rows
+
+    # Iterates over the records as (timestamp, direction, code, payload), for the code and time range given
+
+    def frames(self, code=None, t0=None, t1=None, direction=None):
+
+        for row in self.select(code, t0, t1, direction):
+            yield int(row['timestamp']), int(row['direction']), int(row['code']), self.payload(row)
+
+    # Raw payload of an index row
+
+    def payload(self, row):
+
+        return self.__map[int(row['offset']):int(row['offset']) + int(row['size'])]
+
+    # Decodes every reply of a fixed size message between t0 and t1 into a structured array, with a column per field
+    # (scaled fields as float64, as the getters return them) and the timestamp column. Shorter payloads (older
+    # firmwares) are padded with zeros, as MspMessage.decode does.
+
+    def messages(self, code, t0=None, t1=None):
+
+        message = MspMessages.get(code)
+        dtype = TelemetryHistory.history_dtype(message) if message is not None else None
+
+        if dtype is None:
+            raise ValueError('Only fixed size MSP messages can be decoded in bulk: ' + str(code))
+
+        rows = self.select(code, t0, t1)
+        wire = numpy.dtype(list(zip(message.fields, TelemetryHistory.field_types(message))))
+        decoded = numpy.zeros(len(rows), dtype=dtype)
+
+        for start in range(0, len(rows), self.CHUNK):
+
+            chunk = rows[start:start + self.CHUNK]
+            values = numpy.frombuffer(self.__gather(chunk, message.size), dtype=wire)
+
+            for field in message.fields:
+                decoded[field][start:start + len(chunk)] = values[field]
+
+        for field, divisor in message.scale.items():
+            decoded[field] /= divisor
+
+        decoded['timestamp'] = rows['timestamp']
+
+        return decoded
+
+    # Copies the payloads of the index rows into a (rows, size) array, the bytes past the end of a payload are zeros
+
+    def __gather(self, rows, size):
+
+        columns = numpy.arange(size, dtype=numpy.uint64)
+        positions = numpy.minimum(rows['offset'][:, None] + columns, len(self.__raw) - 1)
+
+        return numpy.where(columns < rows['size'][:, None], self.__raw[positions], 0).astype(numpy.uint8)
+
+    # Positions on the index of the records of a command, computed once per (code, direction)
+
+    def __positions(self, code, direction):
+
+        key = (code, direction)
+        positions = self.__by_code.get(key)
+
+        if positions is None:
+            match = self.index['code'] == code
+            if direction is not None:
+                match &= self.index['direction'] == direction
+            positions = numpy.flatnonzero(match)
+            self.__by_code[key] = positions
+
+        return positions
+
+    # Scans the record headers. A record cut by the end of the file (log still being written) is not indexed.
+
+    def __build_index(self):
+
+        record = FlightRecorder.RECORD
+        data = self.__map
+        length = len(data)
+        offset = FlightRecorder.HEADER.size
+        entries = []
+
+        while offset + record.size <= length:
+
+            timestamp, direction, code, size = record.unpack_from(data, offset)
+            offset += record.size
+
+            if offset + size > length:
+                break
+
+            entries.append((timestamp, direction, code, size, offset))
+            offset += size
+
+        index = numpy.array(entries, dtype=INDEX_DTYPE)
+
+        # Records queued from several threads may be a few microseconds out of order
+        return index[numpy.argsort(index['timestamp'], kind='stable')]
+
+    def __load_index(self):
+
+        try:
+            index = numpy.load(self.path + '.idx.npy')
+        except (OSError, ValueError):
+            return None
+
+        if index.dtype != numpy.dtype(INDEX_DTYPE):
+            return None
+
+        # The index is stale if the log has grown since it was saved
+        end = FlightRecorder.HEADER.size
+        if len(index):
+            last = numpy.argmax(index['offset'])
+            end = int(index['offset'][last]) + int(index['size'][last])
+
+        if end != len(self.__map):
+            return None
+
+        return index
+
+    def __save_index(self):
+
+        try:
+            numpy.save(self.path + '.idx.npy', self.index)
+        except OSError as err:
+            log.error('Flight log exception: %s', err)
+
+
+# Paths of the logs of a directory, in recording order
+
+def list_logs(directory='logs'):
+
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.msplog'))
@@ -0,0 +1,147 @@
+import os
+import struct
+import threading
+import time
+
+from collections import deque
+
+from src.Multiwii import Logger
+
+log = Logger.get_logger('FlightRecorder')
+
+# File header: magic, monotonic and wall clock times (ns) when the file was opened, to place the records in time
+HEADER = struct.Struct('<8sqq')
+MAGIC = b'MSPLOG\x00\x01'
+
+# Record header, followed by the payload: monotonic time (ns), direction, command ID and payload size
+RECORD = struct.Struct('<QBHH')
+
+# Record directions: the byte of the MSP direction of the frame
+OUT = ord('<')
+IN = ord('>')
+ERROR = ord('!')
+
+
+# Appends every MSP frame sent to or received from the flight controller to a compact binary log. record() only queues
+# the frame, a writer thread packs and writes the queued records every flush_interval seconds so the serial path never
+# waits for the SD card. A new file is started when the current one reaches max_bytes; files are named
+# <prefix>-<date>-<index>.msplog and each one starts with its own header, so they can be read independently.
+# If the writer falls behind more than max_pending records the new ones are dropped and counted.
+
+class FlightRecorder(object):
+
+    def __init__(self, directory='logs', prefix='flight', max_bytes=16 * 1024 * 1024, flush_interval=0.5,
+                 max_pending=100000):
+
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.running = False
+        self.records = 0
+        self.dropped = 0
+        self.bytes_written = 0
+        self.files = []
+
+        self.__pending = deque()
+        self.__file = None
+        self.__file_size = 0
+        self.__name = None
+        self.__index = 0
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+
+        if not self.running:
+            os.makedirs(self.directory, exist_ok=True)
+            self.__name = time.strftime('%Y%m%d-%H%M%S')
+            self.__index = 0
+            self.__open()
+            self.running = True
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__loop, name='FlightRecorder', daemon=True)
+            self.__thread.start()
+
+        return self
+
+    # Stops the writer thread once every queued record has been written, and closes the file
+
+    def stop(self):
+
+        self.running = False
+        self.__stop.set()
+
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+        if self.__file is not None:
+            self.__flush()
+            self.__file.close()
+            self.__file = None
+
+    # Queues a frame: direction is OUT, IN or ERROR and payload the raw MSP payload
+
+    def record(self, direction, code, payload):
+
+        if not self.running:
+            return
+
+        if len(self.__pending) >= self.max_pending:
+            self.dropped += 1
+            return
+
+        self.__pending.append((time.monotonic_ns(), direction, code, payload))
+
+    def __loop(self):
+
+        while not self.__stop.wait(self.flush_interval):
+            self.__flush()
+
+    def __flush(self):
+
+        pending = self.__pending
+        parts = []
+        size = 0
+
+        while pending:
+
+            timestamp, direction, code, payload = pending.popleft()
+            parts.append(RECORD.pack(timestamp, direction, code, len(payload)))
+            parts.append(payload)
+            size += RECORD.size + len(payload)
+            self.records += 1
+
+        if not parts:
+            return
+
+        try:
+            self.__file.write(b''.join(parts))
+            self.__file.flush()
+
+        except OSError as err:
+            log.error('Flight recorder exception: %s', err)
+            return
+
+        self.bytes_written += size
+        self.__file_size += size
+
+        if self.__file_size >= self.max_bytes:
+            self.__file.close()
+            self.__open()
+
+    def __open(self):
+
+        # Never overwrites a log, e.g. of a recorder started on the same second
+        while True:
+            path = os.path.join(self.directory, '%s-%s-%03d.msplog' % (self.prefix, self.__name, self.__index))
+            self.__index += 1
+            if not os.path.exists(path):
+                break
+
+        self.__file = open(path, 'wb')
+        self.__file.write(HEADER.pack(MAGIC, time.monotonic_ns(), time.time_ns()))
+        self.__file_size = HEADER.size
+        self.files.append(path)
@@ -0,0 +1,127 @@
+# Histogram of durations in nanoseconds with fixed log-linear buckets: every power of two is split in SUB_BUCKETS linear
+# buckets, so any value is counted with a relative error below 1/SUB_BUCKETS (6%) from 1 ns to MAX_VALUE, with a
+# fixed number of counters and no allocation when a value is recorded. Longer durations are counted on the last bucket.
+
+class LatencyHistogram(object):
+
+    SUB_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BITS
+    # About 18 minutes
+    MAX_VALUE = (1 << 40) - 1
+
+    BUCKETS = (MAX_VALUE.bit_length() - SUB_BITS + 1) * SUB_BUCKETS
+
+    def __init__(self):
+
+        self.counts = [0] * LatencyHistogram.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+
+        if value < 0:
+            value = 0
+        elif value > LatencyHistogram.MAX_VALUE:
+            value = LatencyHistogram.MAX_VALUE
+
+        self.counts[LatencyHistogram.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    def reset(self):
+
+        self.counts = [0] * LatencyHistogram.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    # Upper bound of the bucket where the p percentile falls (never above the maximum recorded)
+
+    def percentile(self, p):
+
+        if not self.count:
+            return 0
+
+        target = max(1, p / 100.0 * self.count)
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(LatencyHistogram.upper_bound(index), self.max)
+
+        return self.max
+
+    # Count, mean, p50, p90, p99 and max, in milliseconds
+
+    def stats(self):
+
+        return {'count': self.count, 'mean': self.total / self.count / 1000000.0 if self.count else 0.0,
+                'p50': self.percentile(50) / 1000000.0, 'p90': self.percentile(90) / 1000000.0,
+                'p99': self.percentile(99) / 1000000.0, 'max': self.max / 1000000.0}
+
+    @staticmethod
+    def bucket(value):
+
+        if value < LatencyHistogram.SUB_BUCKETS:
+            return value
+
+        shift = value.bit_length() - LatencyHistogram.SUB_BITS - 1
+
+        return (shift + 1) * LatencyHistogram.SUB_BUCKETS + (value >> shift) - LatencyHistogram.SUB_BUCKETS
+
+    @staticmethod
+    def upper_bound(index):
+
+        if index < LatencyHistogram.SUB_BUCKETS:
+            return index
+
+        shift = index // LatencyHistogram.SUB_BUCKETS - 1
+        mantissa = index % LatencyHistogram.SUB_BUCKETS + LatencyHistogram.SUB_BUCKETS
+
+        return ((mantissa + 1) << shift) - 1
+
+
+# Timing of the MSP transactions, measured with perf_counter_ns (monotonic, not affected by NTP), by command ID and
+# phase: write is the time taken by the serial write, first_byte the time from the end of the write to the first byte
+# of the reply and frame the time from the end of the write to the complete reply.
+
+class LatencyStats(object):
+
+    PHASES = ('write', 'first_byte', 'frame')
+
+    def __init__(self):
+
+        self.histograms = {}
+
+    # Records a transaction. Times are perf_counter_ns() values, first_byte and received are None without reply.
+
+    def record(self, cmd, write_start, written, first_byte=None, received=None):
+
+        histograms = self.histograms.get(cmd)
+
+        if histograms is None:
+            histograms = self.histograms[cmd] = tuple(LatencyHistogram() for _ in LatencyStats.PHASES)
+
+        histograms[0].record(written - write_start)
+
+        if first_byte is not None:
+            histograms[1].record(first_byte - written)
+
+        if received is not None:
+            histograms[2].record(received - written)
+
+    def reset(self):
+
+        self.histograms.clear()
+
+    # {cmd: {phase: {'count', 'mean', 'p50', 'p90', 'p99', 'max'}}}, times in milliseconds
+
+    def stats(self):
+
+        return dict((cmd, dict(zip(LatencyStats.PHASES, (histogram.stats() for histogram in histograms))))
+                    for cmd, histograms in list(self.histograms.items()))
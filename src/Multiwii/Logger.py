@@ -0,0 +1,99 @@
+import logging
+import logging.handlers
+import queue
+import time
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+__listener = None
+
+
+# Returns the logger of a module of the server ('multiwii.<name>'). Messages use the lazy %-style arguments, so a
+# disabled level costs a method call and a level check: nothing is formatted.
+
+def get_logger(name):
+
+    return logging.getLogger('multiwii.' + name)
+
+
+# Sends the server logs through a queue to a listener thread that does the console (or file) I/O, so the control and
+# telemetry paths only append a record to the queue. Handler is where the records end, stderr by default. Call
+# shutdown() to flush the queue before exiting.
+
+def setup(level=logging.INFO, handler=None):
+
+    global __listener
+
+    shutdown()
+
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(FORMAT))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger('multiwii')
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+    root.propagate = False
+
+    __listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    __listener.start()
+
+    return __listener
+
+
+def shutdown():
+
+    global __listener
+
+    if __listener is not None:
+        __listener.stop()
+        __listener = None
+
+
+# Logs at most one message every interval seconds, for the per-packet paths (SET_RC, telemetry datagrams, ...). The
+# messages dropped in between are counted and reported with the next one.
+
+class RateLimitedLogger(object):
+
+    def __init__(self, logger, interval=1.0):
+
+        self.logger = logger
+        self.interval = interval
+        self.suppressed = 0
+
+        self.__next = 0.0
+
+    # The level is checked before anything else, so a disabled level only costs that check
+
+    def debug(self, msg, *args):
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.__log(logging.DEBUG, msg, args)
+
+    def info(self, msg, *args):
+
+        if self.logger.isEnabledFor(logging.INFO):
+            self.__log(logging.INFO, msg, args)
+
+    def warning(self, msg, *args):
+
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.__log(logging.WARNING, msg, args)
+
+    def __log(self, level, msg, args):
+
+        now = time.monotonic()
+
+        if now < self.__next:
+            self.suppressed += 1
+            return
+
+        self.__next = now + self.interval
+
+        if self.suppressed:
+            msg += ' (%d suppressed)'
+            args += (self.suppressed,)
+            self.suppressed = 0
+
+        self.logger.log(level, msg, *args)
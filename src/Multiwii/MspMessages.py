@@ -0,0 +1,259 @@
+import struct
+
+from collections import namedtuple
+
+
+# Describes the payload of a MSP message: its fields, their struct types and the divisor applied to scaled fields
+# (e.g. the attitude angles are sent in tenths of degree). The struct is compiled once, when the registry is built.
+
+class MspMessage(object):
+
+    def __init__(self, code, name, fields, fmt, scale=None, attribute=None, invalidates=None):
+
+        self.code = code
+        self.name = name
+        self.fields = fields
+        self.struct = struct.Struct('<' + fmt)
+        self.size = self.struct.size
+        self.scale = scale or {}
+        # Drone attribute where the decoded values are stored, only used by the getters
+        self.attribute = attribute
+        # Getters whose cached values are changed by this message, only used by the setters
+        self.invalidates = invalidates or []
+        # Immutable snapshot stored on the Drone: the fields, the round trip time and the monotonic reception time, both
+        # in integer nanoseconds
+        self.snapshot = namedtuple(name.title().replace('_', ''), fields + ['elapsed', 'timestamp'])
+
+        self.__scaled = [(fields.index(field), divisor) for field, divisor in self.scale.items()]
+
+    # Decodes a payload into a tuple with the value of each field. Shorter payloads (older firmwares) are padded with
+    # zeros.
+
+    def decode(self, data):
+
+        if len(data) < self.size:
+            data = bytes(data) + bytes(self.size - len(data))
+
+        values = self.struct.unpack_from(data)
+
+        if self.__scaled:
+            values = list(values)
+            for i, divisor in self.__scaled:
+                values[i] = values[i] / divisor
+            values = tuple(values)
+
+        return values
+
+    def encode(self, values):
+
+        if self.__scaled:
+            values = list(values)
+            for i, divisor in self.__scaled:
+                values[i] = int(round(values[i] * divisor))
+
+        return self.struct.pack(*values)
+
+    # Values of the given fields of a decoded snapshot in the units sent by the flight controller, as integers: the
+    # scaled fields are multiplied back by their divisor (e.g. the attitude angles in tenths of degree). They are
+    # saturated to the signed 16 bits words of the telemetry packages (e.g. an altitude above 327.67 m).
+
+    def raw_values(self, values, fields):
+
+        raw = [int(round(getattr(values, field) * self.scale[field])) if field in self.scale
+               else int(getattr(values, field)) for field in fields]
+
+        return [min(max(value, -0x8000), 0x7FFF) for value in raw]
+
+
+# Messages whose payload is a variable number of elements of the same type (box activations, box IDs, RC channels to
+# set, ...). Structs are cached by element count.
+
+class MspArrayMessage(MspMessage):
+
+    def __init__(self, code, name, fmt, attribute=None, invalidates=None):
+
+        MspMessage.__init__(self, code, name, ['values'], '', attribute=attribute, invalidates=invalidates)
+        self.element = struct.Struct('<' + fmt)
+        self.__structs = {}
+
+    def decode(self, data):
+
+        count = len(data) // self.element.size
+        return (self.__struct(count).unpack_from(data),)
+
+    def encode(self, values):
+
+        return self.__struct(len(values)).pack(*values)
+
+    def __struct(self, count):
+
+        array_struct = self.__structs.get(count)
+
+        if array_struct is None:
+            array_struct = struct.Struct('<%d%s' % (count, self.element.format[1:]))
+            self.__structs[count] = array_struct
+
+        return array_struct
+
+
+# Messages whose payload is a list of names separated by ';' (BOXNAMES, PIDNAMES)
+
+class MspNamesMessage(MspMessage):
+
+    def __init__(self, code, name, attribute=None):
+
+        MspMessage.__init__(self, code, name, ['values'], '', attribute=attribute)
+
+    def decode(self, data):
+
+        return (tuple(name for name in bytes(data).decode('ascii', 'replace').split(';') if name),)
+
+    def encode(self, values):
+
+        return ''.join(name + ';' for name in values).encode('ascii')
+
+
+# MSP_MULTIPLE_MSP (newer firmwares): the request payload is a list of getter IDs (8 bits) and the reply payload holds
+# the reply of each one preceded by its size, in request order. The replies that do not fit the firmware buffer are
+# left out. Decoding returns the raw reply, split() splits it by command.
+
+class MspMultipleMessage(MspArrayMessage):
+
+    def __init__(self, code, name):
+
+        MspArrayMessage.__init__(self, code, name, 'B')
+
+    def decode(self, data):
+
+        return (bytes(data),)
+
+    # Yields (cmd, payload) for every reply found on the payload of a MSP_MULTIPLE_MSP reply
+
+    @staticmethod
+    def split(cmds, data):
+
+        i = 0
+
+        for cmd in cmds:
+
+            if i >= len(data) or i + 1 + data[i] > len(data):
+                return
+
+            size = data[i]
+            yield cmd, data[i + 1:i + 1 + size]
+            i += 1 + size
+
+
+PID_FIELDS = ['rp', 'ri', 'rd', 'pp', 'pi', 'pd', 'yp', 'yi', 'yd', 'altp', 'alti', 'altd', 'posp', 'posi', 'posd',
+              'posrp', 'posri', 'posrd', 'navrp', 'navri', 'navrd', 'levelp', 'leveli', 'leveld', 'magp', 'magi',
+              'magd', 'velp', 'veli', 'veld']
+
+MISC_FIELDS = ['power_trigger', 'min_throttle', 'max_throttle', 'min_command', 'failsafe_throttle', 'arm_count',
+               'lifetime', 'mag_declination', 'vbat_scale', 'vbat_warn1', 'vbat_warn2', 'vbat_critical']
+
+RC_TUNING_FIELDS = ['rc_rate', 'rc_expo', 'roll_pitch_rate', 'yaw_rate', 'dyn_thr_pid', 'throttle_mid',
+                    'throttle_expo']
+
+WP_FIELDS = ['wp_no', 'lat', 'lon', 'alt_hold', 'heading', 'time_to_stay', 'nav_flag']
+
+
+# MSP registry, keyed by message ID. Getters have an attribute, which is the name of the Drone attribute where their
+# values are stored and also names the generated MultiWii getter (get_<name>).
+
+MESSAGES = dict((message.code, message) for message in [
+
+    # Capability detection, only answered by the newer firmwares (Betaflight, iNav, ...)
+    MspMessage(1, 'api_version', ['msp_protocol', 'api_major', 'api_minor'], '3B'),
+    MspNamesMessage(2, 'fc_variant'),
+    MspMultipleMessage(230, 'multiple_msp'),
+
+    # Getters
+    MspMessage(100, 'ident', ['version', 'multitype', 'msp_version', 'capability'], '3BI', attribute='ident'),
+    MspMessage(101, 'status', ['cycle_time', 'i2c_errors', 'sensor', 'flag', 'current_set'], '3HIB',
+               attribute='status'),
+    MspMessage(102, 'raw_imu', ['accx', 'accy', 'accz', 'gyrx', 'gyry', 'gyrz', 'magx', 'magy', 'magz'], '9h',
+               attribute='raw_imu'),
+    MspMessage(103, 'servo', ['s1', 's2', 's3', 's4', 's5', 's6', 's7', 's8'], '8H', attribute='servo'),
+    MspMessage(104, 'motor', ['m1', 'm2', 'm3', 'm4', 'm5', 'm6', 'm7', 'm8'], '8H', attribute='motor'),
+    MspMessage(105, 'rc', ['roll', 'pitch', 'yaw', 'throttle', 'aux1', 'aux2', 'aux3', 'aux4'], '8H',
+               attribute='rc_channels'),
+    MspMessage(106, 'raw_gps', ['fix', 'num_sat', 'lat', 'lon', 'alt', 'speed', 'ground_course'], '2B2i3H',
+               scale={'lat': 10000000.0, 'lon': 10000000.0, 'ground_course': 10.0}, attribute='raw_gps'),
+    MspMessage(107, 'comp_gps', ['distance_to_home', 'direction_to_home', 'update'], 'HhB', attribute='comp_gps'),
+    MspMessage(108, 'attitude', ['angx', 'angy', 'heading'], '3h', scale={'angx': 10.0, 'angy': 10.0},
+               attribute='attitude'),
+    MspMessage(109, 'altitude', ['estalt', 'vario'], 'ih', attribute='altitude'),
+    MspMessage(110, 'analog', ['vbat', 'power_meter_sum', 'rssi', 'amperage'], 'B3H', scale={'vbat': 10.0},
+               attribute='analog'),
+    MspMessage(111, 'rc_tuning', RC_TUNING_FIELDS, '7B', attribute='rc_tuning'),
+    MspMessage(112, 'pid_coef', PID_FIELDS, '30B', attribute='PID_coef'),
+    MspArrayMessage(113, 'box', 'H', attribute='box'),
+    MspMessage(114, 'misc', MISC_FIELDS, '6HIh4B', scale={'mag_declination': 10.0}, attribute='misc'),
+    MspMessage(115, 'motor_pins', ['p1', 'p2', 'p3', 'p4', 'p5', 'p6', 'p7', 'p8'], '8B', attribute='motor_pins'),
+    MspNamesMessage(116, 'boxnames', attribute='boxnames'),
+    MspNamesMessage(117, 'pidnames', attribute='pidnames'),
+    MspMessage(118, 'wp', WP_FIELDS, 'B3i2HB', attribute='wp'),
+    MspArrayMessage(119, 'boxids', 'B', attribute='boxids'),
+
+    # Setters
+    MspArrayMessage(200, 'set_raw_rc', 'H'),
+    MspMessage(201, 'set_raw_gps', ['fix', 'num_sat', 'lat', 'lon', 'alt', 'speed'], '2B2i2H',
+               scale={'lat': 10000000.0, 'lon': 10000000.0}),
+    MspMessage(202, 'set_pid', PID_FIELDS, '30B', invalidates=[112]),
+    MspArrayMessage(203, 'set_box', 'H', invalidates=[113]),
+    MspMessage(204, 'set_rc_tuning', RC_TUNING_FIELDS, '7B', invalidates=[111]),
+    MspMessage(205, 'acc_calibration', [], ''),
+    MspMessage(206, 'mag_calibration', [], ''),
+    MspMessage(207, 'set_misc', MISC_FIELDS, '6HIh4B', scale={'mag_declination': 10.0}, invalidates=[114]),
+    MspMessage(208, 'reset_conf', [], '', invalidates=[111, 112, 113, 114]),
+    MspMessage(209, 'set_wp', WP_FIELDS, 'B3i2HB', invalidates=[118]),
+])
+
+# Getters that store their values on the Drone, in registry order
+GETTERS = [message for message in MESSAGES.values() if message.attribute]
+
+# Fallback for the commands that are not on the registry, payloads are handled as unsigned 16 bits words
+__words = {}
+
+
+def get(code):
+
+    return MESSAGES.get(code)
+
+
+def decode(code, data):
+
+    message = MESSAGES.get(code)
+
+    if message is not None:
+        return message.decode(data)
+
+    return words(len(data) // 2).unpack_from(data)
+
+
+# Registered messages are encoded with their layout, raises ValueError if the number of values does not match their
+# fields. The other commands are encoded as unsigned 16 bits words.
+
+def encode(code, values):
+
+    message = MESSAGES.get(code)
+
+    if message is None:
+        return words(len(values)).pack(*values)
+
+    if not isinstance(message, (MspArrayMessage, MspNamesMessage)) and len(values) != len(message.fields):
+        raise ValueError('MSP message %d (%s) takes %d values, %d given' % (code, message.name, len(message.fields),
+                                                                           len(values)))
+
+    return message.encode(values)
+
+
+def words(count):
+
+    words_struct = __words.get(count)
+
+    if words_struct is None:
+        words_struct = struct.Struct('<%dH' % count)
+        __words[count] = words_struct
+
+    return words_struct
@@ -0,0 +1,245 @@
+import struct
+
+from collections import namedtuple
+
+# A complete and validated MSP frame. Error is True when the flight controller answered with the '!' direction, which
+# means that the command is unknown or has been rejected. Version is the framing it was received with, 1 ($M) or 2 ($X).
+MspFrame = namedtuple('MspFrame', ['cmd', 'data', 'error', 'version'])
+
+
+# CRC8 DVB-S2 (polynomial 0xD5) of MSP v2, computed with a table of the 256 byte values
+
+def __crc8_table():
+
+    table = []
+
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0xD5) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+
+    return bytes(table)
+
+
+CRC8_TABLE = __crc8_table()
+
+
+def crc8_dvb_s2(data, crc=0):
+
+    for b in data:
+        crc = CRC8_TABLE[crc ^ b]
+
+    return crc
+
+
+class MspParser(object):
+
+    # Parser states
+    IDLE = 0
+    PREAMBLE = 1
+    DIRECTION = 2
+    SIZE = 3
+    CMD = 4
+    PAYLOAD = 5
+    CHECKSUM = 6
+    HEADER_V2 = 7
+
+    HEADER = 0x24  # '$'
+    PREAMBLE_V1 = 0x4D  # 'M'
+    PREAMBLE_V2 = 0x58  # 'X'
+    # Flag, command ID and payload size of the MSP v2 header
+    V2_HEADER_SIZE = 5
+    V2_HEADER = struct.Struct('<BHH')
+    ERROR = 0x21  # '!'
+
+    # Direction is b'>' to parse the replies of the flight controller, or b'<' to parse the requests sent to it. Both
+    # MSP v1 ($M, 8 bits ID and size, XOR checksum) and MSP v2 ($X, 16 bits ID and size, CRC8 DVB-S2) frames are
+    # parsed.
+
+    def __init__(self, direction=b'>'):
+
+        self.direction = direction[0]
+        self.bytes_received = 0
+        self.frames = 0
+        self.checksum_errors = 0
+        self.error_frames = 0
+        self.skipped_bytes = 0
+        # FlightRecorder where every valid frame is recorded, if any
+        self.recorder = None
+        # Timestamp given to feed() with the chunk where the header of the last yielded frame was received
+        self.frame_started = None
+
+        self.__state = MspParser.IDLE
+        self.__error = False
+        self.__version = 1
+        # The MSP v2 header and the payload are copied to these buffers as they are received, and the payload is copied
+        # once more to the bytes of the frame. They are reused by every frame, the payload one grows for larger ones.
+        self.__header = bytearray(MspParser.V2_HEADER_SIZE)
+        self.__payload = bytearray(256)
+        self.__received = 0
+        self.__size = 0
+        self.__cmd = 0
+        self.__checksum = 0
+        self.__started = None
+
+    # Feeds a chunk of bytes of any length to the parser and yields every complete frame found on it. Partial frames
+    # are kept until the next call, garbage and frames with a wrong checksum are dropped and the parser resyncs on the
+    # next header. Timestamp is the reception time of the chunk, kept as frame_started for the frames it starts.
+
+    def feed(self, chunk, timestamp=None):
+
+        i = 0
+        length = len(chunk)
+        view = memoryview(chunk)
+        self.bytes_received += length
+
+        while i < length:
+
+            state = self.__state
+
+            if state == MspParser.IDLE:
+                start = chunk.find(b'$', i)
+                if start < 0:
+                    self.skipped_bytes += length - i
+                    return
+                self.skipped_bytes += start - i
+                self.__started = timestamp
+                self.__state = MspParser.PREAMBLE
+                i = start + 1
+                continue
+
+            if state == MspParser.HEADER_V2:
+                received = self.__received
+                needed = min(MspParser.V2_HEADER_SIZE - received, length - i)
+                self.__header[received:received + needed] = view[i:i + needed]
+                self.__received += needed
+                i += needed
+                if self.__received == MspParser.V2_HEADER_SIZE:
+                    _, self.__cmd, self.__size = MspParser.V2_HEADER.unpack_from(self.__header)
+                    self.__checksum = crc8_dvb_s2(self.__header)
+                    self.__start_payload()
+                continue
+
+            if state == MspParser.PAYLOAD:
+                received = self.__received
+                needed = min(self.__size - received, length - i)
+                self.__payload[received:received + needed] = view[i:i + needed]
+                self.__received += needed
+                i += needed
+                if self.__received == self.__size:
+                    self.__state = MspParser.CHECKSUM
+                continue
+
+            byte = chunk[i]
+            i += 1
+
+            if state == MspParser.PREAMBLE:
+                if byte == MspParser.PREAMBLE_V1 or byte == MspParser.PREAMBLE_V2:
+                    self.__version = 1 if byte == MspParser.PREAMBLE_V1 else 2
+                    self.__state = MspParser.DIRECTION
+                else:
+                    self.__resync(byte)
+
+            elif state == MspParser.DIRECTION:
+                if byte == self.direction or byte == MspParser.ERROR:
+                    self.__error = byte == MspParser.ERROR
+                    if self.__version == 1:
+                        self.__state = MspParser.SIZE
+                    else:
+                        self.__received = 0
+                        self.__state = MspParser.HEADER_V2
+                else:
+                    self.__resync(byte)
+
+            elif state == MspParser.SIZE:
+                self.__size = byte
+                self.__checksum = byte
+                self.__state = MspParser.CMD
+
+            elif state == MspParser.CMD:
+                self.__cmd = byte
+                self.__checksum ^= byte
+                self.__start_payload()
+
+            elif state == MspParser.CHECKSUM:
+                self.__state = MspParser.IDLE
+
+                payload = memoryview(self.__payload)[:self.__size]
+                checksum = self.__checksum
+                if self.__version == 1:
+                    for b in payload:
+                        checksum ^= b
+                else:
+                    checksum = crc8_dvb_s2(payload, checksum)
+
+                if checksum != byte:
+                    self.checksum_errors += 1
+                    continue
+
+                self.frames += 1
+                if self.__error:
+                    self.error_frames += 1
+
+                frame = MspFrame(self.__cmd, payload.tobytes(), self.__error, self.__version)
+                self.frame_started = self.__started
+
+                if self.recorder is not None:
+                    self.recorder.record(MspParser.ERROR if frame.error else self.direction, frame.cmd, frame.data)
+
+                yield frame
+
+    def __start_payload(self):
+
+        self.__received = 0
+        self.__state = MspParser.PAYLOAD if self.__size else MspParser.CHECKSUM
+
+        if self.__size > len(self.__payload):
+            self.__payload = bytearray(self.__size)
+
+    # Drops the partially parsed frame, the current byte may be the header of a new one.
+
+    def __resync(self, byte):
+
+        self.skipped_bytes += 1
+
+        if byte == MspParser.HEADER:
+            self.__state = MspParser.PREAMBLE
+        else:
+            self.__state = MspParser.IDLE
+
+
+# Frame structs by MSP version and payload size, see frame_struct
+__frames = {}
+
+
+# Builds a MSP frame. Direction is b'<' for requests and b'>' for replies. Version 1 frames are the header, data length,
+# command ID, payload and XOR checksum, version 2 frames the header, flag, command ID, data length (16 bits both),
+# payload and CRC8 DVB-S2 of everything after the header, for command IDs above 255 and payloads up to 64 KB.
+
+# Each frame is packed with a single struct call, without concatenating its parts.
+
+def create_frame(code, payload, direction=b'<', version=1):
+
+    size = len(payload)
+
+    if version == 2:
+        checksum = crc8_dvb_s2(payload, crc8_dvb_s2((0, code & 0xFF, code >> 8, size & 0xFF, size >> 8)))
+        return frame_struct(2, size).pack(b'$X', direction, 0, code, size, payload, checksum)
+
+    checksum = size ^ code
+    for b in payload:
+        checksum ^= b
+
+    return frame_struct(1, size).pack(b'$M', direction, size, code, payload, checksum)
+
+
+def frame_struct(version, size):
+
+    frame = __frames.get((version, size))
+
+    if frame is None:
+        frame = struct.Struct(('<2scBHH%dsB' if version == 2 else '<2sc2B%dsB') % size)
+        __frames[(version, size)] = frame
+
+    return frame
@@ -1,13 +1,27 @@
 import socket
 import time
 import serial
-import struct
 
-from src.Multiwii import MultiwiiSettings, Drone
+from concurrent.futures import Future, CancelledError, TimeoutError as FutureTimeoutError
+
+from src.Multiwii import MultiwiiSettings, Drone, MspParser, MspMessages, SerialWorker, TelemetryScheduler, \
+    RcStreamer, TelemetryHistory, FlightRecorder, LatencyHistogram, Logger, ConfigCache, TelemetryBundle, \
+    TelemetryDelta
+
+log = Logger.get_logger('MultiWii')
+# Per request/packet messages (serial errors, RC values, telemetry datagrams), at most one per second
+serial_log = Logger.RateLimitedLogger(log)
+rc_log = Logger.RateLimitedLogger(log)
+udp_log = Logger.RateLimitedLogger(log)
 
 
 class MultiWii(object):
     # Multiwii Serial Protocol message IDs.
+    # Capability detection and batched requests, only answered by the newer firmwares
+    API_VERSION = 1
+    FC_VARIANT = 2
+    MULTIPLE_MSP = 230
+
     # Getters
     IDENT = 100
     STATUS = 101
@@ -46,95 +60,448 @@ class MultiWii(object):
     IS_SERIAL = 211
     DEBUG = 254
 
-    def __init__(self):
+    # Seconds an arm/disarm profile may take longer than its steps before it is given up
+    PROFILE_MARGIN = 1.0
+
+    # Getters that can be polled by the telemetry loops, with the settings flag that enables each one
+    TELEMETRY_FLAGS = [(ALTITUDE, 'MSP_ALTITUDE'), (ATTITUDE, 'MSP_ATTITUDE'), (RAW_IMU, 'MSP_RAW_IMU'), (RC, 'MSP_RC'),
+                       (MOTOR, 'MSP_MOTOR'), (SERVO, 'MSP_SERVO'), (PID, 'MSP_PID')]
+
+    # Values sent on each UDP telemetry package, by getter. Scaled values are sent in the units of the flight controller
+    # (the attitude angles in tenths of degree), see MspMessage.raw_values.
+    UDP_FIELDS = {
+        ALTITUDE: ['estalt', 'vario'],
+        ATTITUDE: ['angx', 'angy', 'heading'],
+        RAW_IMU: ['accx', 'accy', 'accz', 'gyrx', 'gyry', 'gyrz', 'magx', 'magy', 'magz'],
+        RC: ['roll', 'pitch', 'yaw', 'throttle'],
+        MOTOR: ['m1', 'm2', 'm3', 'm4'],
+        SERVO: ['s1', 's2', 's3', 's4'],
+        PID: ['rp', 'ri', 'rd', 'pp', 'pi', 'pd', 'yp', 'yi', 'yd'],
+    }
+
+    # Settings can be given to use another serial port (e.g. the simulator), by default the settings file is used
+
+    def __init__(self, settings=None):
 
         self.drone = Drone.Drone()
         self.udp_server_started = False
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_telemetry = False
         self.telemetry = False
+        self.telemetry_ticks = 0
+        # Hot path counters, see stats
+        self.bytes_written = 0
+        self.rc_written = 0
+        self.datagrams_sent = 0
+        self.datagram_bytes_sent = 0
+        self.telemetry_scheduler = None
+        self.udp_telemetry_scheduler = None
+        self.parser = MspParser.MspParser()
+        self.worker = None
+        self.rc_streamer = None
+        self.recorder = None
+        # MSP framing used (1 or 2) and firmware capabilities, detected at connect (see __detect_protocol)
+        self.msp_version = 1
+        self.api_version = None
+        self.fc_variant = None
+        self.multiple_msp = False
+        # Timing of the MSP transactions by command, see latency_stats
+        self.latency = LatencyHistogram.LatencyStats()
 
         try:
-            self.settings = MultiwiiSettings.Settings()
+            self.settings = settings or MultiwiiSettings.Settings()
             self.serial = self.settings.serial_port
+            self.cache = ConfigCache.ConfigCache(self.settings.config_ttl)
+
+            if self.settings.history_capacity:
+                self.drone.history = TelemetryHistory.TelemetryHistory(self.settings.history_capacity)
+
             self.serial.open()
             time.sleep(self.settings.wakeup)
+            self.__detect_protocol()
+
+            if self.settings.flight_recorder:
+                self.start_recorder()
+
+            if self.settings.serial_worker:
+                self.start_worker()
+
         except ValueError as err:
-            print('Serial port exception:' + str(err) + '\n')
+            log.error('Serial port exception: %s', err)
+
+    # Starts the thread that owns the serial port, from then on every command goes through its queue and several
+    # threads can use the MultiWii at the same time.
+
+    def start_worker(self):
+
+        if self.worker is None:
+            self.worker = SerialWorker.SerialWorker(self.serial, self.parser, self.settings.msp_timeout,
+                                                    self.settings.serial_window)
+            self.worker.recorder = self.recorder
+            self.worker.msp_version = self.msp_version
+            self.worker.latency = self.latency
+            self.worker.start()
+
+    def stop_worker(self):
+
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+
+    # Starts recording every MSP frame sent and received to the flight logs, see FlightRecorder
+
+    def start_recorder(self):
+
+        if self.recorder is None:
+            self.recorder = FlightRecorder.FlightRecorder(self.settings.recorder_directory,
+                                                          max_bytes=self.settings.recorder_max_bytes).start()
+            self.parser.recorder = self.recorder
+
+            if self.worker is not None:
+                self.worker.recorder = self.recorder
+
+        return self.recorder
+
+    def stop_recorder(self):
+
+        if self.recorder is not None:
+            self.parser.recorder = None
+
+            if self.worker is not None:
+                self.worker.recorder = None
+
+            self.recorder.stop()
+            self.recorder = None
+
+    # Sends a MSP getter without waiting for its reply. Returns a Future whose result is (total_data, elapsed), it can
+    # be waited with result() or awaited from asyncio with asyncio.wrap_future(). Requires the serial worker.
+
+    def request(self, cmd, timeout=None, priority=SerialWorker.SerialWorker.QUERY):
+
+        return self.worker.submit(cmd, timeout=timeout, priority=priority, max_delay=self.__max_delay(priority))
 
     # Sends a command through serial port to the MultiWii using the MSP. Where code is the ID of the command of the MSP,
     # data is the values to be send, nda data_length is the length in bytes of the data.
 
     def send_cmd(self, data_length, code, data):
 
-        checksum = 0
-        total_data = ['$', 'M', '<', data_length, code] + data
-        for i in struct.pack('<2B%dH' % len(data), *total_data[3:len(total_data)]):
-            checksum = checksum ^ ord(chr(i))
-        total_data.append(checksum)
+        message = MspMessages.get(code)
 
-        try:
+        if message is not None and message.invalidates:
+            self.cache.invalidate(message.invalidates)
 
-            header = struct.pack('<c', total_data[0].encode('ascii'))
-            preamble = struct.pack('<c', total_data[1].encode('ascii'))
-            direction = struct.pack('<c', total_data[2].encode('ascii'))
-            data = struct.pack('2B%dHB' % len(data), *total_data[3:len(total_data)])
+        if self.worker is not None:
+            return self.worker.submit(code, data, reply=False, priority=SerialWorker.SerialWorker.CONTROL)
 
-            package = header + preamble + direction + data
+        payload = MspMessages.encode(code, data)
 
-            b = None
-            b = self.serial.write(package)
+        try:
+            frame = MspParser.create_frame(code, payload, b'<', self.msp_version)
+            write_start = time.perf_counter_ns()
+            self.serial.write(frame)
+            self.latency.record(code, write_start, time.perf_counter_ns())
+            self.bytes_written += len(frame)
+
+            if self.recorder is not None:
+                self.recorder.record(FlightRecorder.OUT, code, payload)
 
         except ValueError as err:
-            print('Serial port exception:' + str(err) + '\n')
+            serial_log.warning('Serial port exception: %s', err)
 
     # Collects data information (ACC, GYR, Altitude, Attitude, ...)
     # Requires a command ID related to the MSP getter commands
 
     def get_data(self, cmd):
 
+        reply = self.get_many([cmd])
+
+        if cmd in reply:
+            return reply[cmd]
+
+    # Collects several data messages in a single round trip. All the requests are written to the serial port at once,
+    # then the replies are read in order and matched by their command ID. Returns a dict {cmd: (total_data, elapsed)},
+    # commands whose reply has not been received are not included. Priority is the serial worker class of the requests.
+    # The configuration messages are answered from the cache while their TTL has not expired.
+
+    def get_many(self, cmds, priority=SerialWorker.SerialWorker.QUERY):
+
+        replies = {}
+        requested = []
+
+        for cmd in cmds:
+            reply = self.cache.get(cmd) if cmd in self.cache else None
+
+            if reply is not None:
+                replies[cmd] = reply
+            else:
+                requested.append(cmd)
+
+        if requested:
+            generations = [(cmd, self.cache.generation(cmd)) for cmd in requested if cmd in self.cache]
+            replies.update(self.__get_many(requested, priority))
+
+            for cmd, generation in generations:
+                if cmd in replies:
+                    self.cache.put(cmd, replies[cmd], generation)
+
+        return replies
+
+    # Drops the cached configuration messages (all of them by default), the next getter reads them again
+
+    def invalidate_cache(self, cmds=None):
+
+        self.cache.invalidate(cmds)
+
+    # Several getters are read with a single MSP_MULTIPLE_MSP request when the firmware supports it. The replies that
+    # did not fit on its reply are requested again.
+
+    def __get_many(self, cmds, priority):
+
+        if not self.multiple_msp or len(cmds) < 2 or max(cmds) > 255:
+            return self.__get_each(cmds, priority)
+
+        replies = self.__get_multiple(cmds, priority)
+        missing = [cmd for cmd in cmds if cmd not in replies]
+
+        if len(missing) == len(cmds):
+            replies.update(self.__get_each(missing, priority))
+        elif missing:
+            replies.update(self.__get_many(missing, priority))
+
+        return replies
+
+    def __get_each(self, cmds, priority):
+
+        if self.worker is not None:
+            return self.__get_many_from_worker(cmds, priority)
+
+        replies = {}
+
         try:
-            start = time.time()
-            self.send_cmd(0, cmd, [])
+            package = b''.join(MspParser.create_frame(cmd, b'', b'<', self.msp_version) for cmd in cmds)
+            write_start = time.perf_counter_ns()
+            self.serial.write(package)
+            written = time.perf_counter_ns()
+            self.bytes_written += len(package)
 
-            header = self.serial.read()
-            while header != b'$':
-                header = self.serial.read()
+            if self.recorder is not None:
+                for cmd in cmds:
+                    self.recorder.record(FlightRecorder.OUT, cmd, b'')
 
-            preamble = self.serial.read()
-            direction = self.serial.read()
-            size = struct.unpack('<b', self.serial.read())[0]
-            cmd = self.serial.read()
-            data = self.serial.read(size)
-            total_data = struct.unpack('<' + 'h' * int((size / 2)), data)
+            for frame, received in self.__read_frames(cmds):
 
-            self.serial.flushInput()
-            self.serial.flushOutput()
+                self.latency.record(frame.cmd, write_start, written, self.parser.frame_started, received)
 
-            elapsed = time.time() - start
+                if frame.error:
+                    serial_log.warning('MSP error reply for command: %d', frame.cmd)
+                    continue
 
-            return total_data, elapsed
+                total_data = MspMessages.decode(frame.cmd, frame.data)
+                replies[frame.cmd] = (total_data, (received - write_start) / 1000000000.0)
 
         except serial.SerialException as err:
-            print('Serial port exception:' + str(err) + '\n')
+            serial_log.warning('Serial port exception: %s', err)
+
+        return replies
+
+    def __get_multiple(self, cmds, priority):
+
+        replies = {}
+
+        try:
+            if self.worker is not None:
+                future = self.worker.submit(MultiWii.MULTIPLE_MSP, cmds, priority=priority,
+                                            max_delay=self.__max_delay(priority))
+                total_data, elapsed = future.result(self.__worker_wait(priority))
+            else:
+                reply, elapsed = self.__transact(MultiWii.MULTIPLE_MSP, MspMessages.encode(MultiWii.MULTIPLE_MSP, cmds))
+                if reply is None or reply.error:
+                    return replies
+                total_data = MspMessages.decode(MultiWii.MULTIPLE_MSP, reply.data)
+
+        except CancelledError:
+            serial_log.warning('MSP request cancelled: %d', MultiWii.MULTIPLE_MSP)
+            return replies
+
+        except (TimeoutError, FutureTimeoutError, ValueError, RuntimeError, serial.SerialException) as err:
+            serial_log.warning('Serial port exception: %s', err)
+            return replies
+
+        for cmd, data in MspMessages.MspMultipleMessage.split(cmds, total_data[0]):
+            replies[cmd] = (MspMessages.decode(cmd, data), elapsed)
+
+        return replies
+
+    def __get_many_from_worker(self, cmds, priority):
+
+        replies = {}
+        futures = [(cmd, self.request(cmd, priority=priority)) for cmd in cmds]
+        deadline = time.monotonic() + self.__worker_wait(priority)
+
+        for cmd, future in futures:
+            try:
+                replies[cmd] = future.result(max(0.0, deadline - time.monotonic()))
+
+            except CancelledError:
+                # Queued requests are cancelled when the worker is stopped
+                serial_log.warning('MSP request cancelled: %d', cmd)
+
+            except (TimeoutError, FutureTimeoutError, ValueError, RuntimeError, serial.SerialException) as err:
+                serial_log.warning('Serial port exception: %s', err)
+
+        return replies
+
+    # Longest wait for the replies of the worker. They fail on their own once the MSP timeout has passed since they were
+    # queued, plus the time a stale request can wait on the queue. Another MSP timeout is allowed for the requests
+    # queued behind a full window, waiting longer means that the worker thread is no longer running.
+
+    def __worker_wait(self, priority):
+
+        return 2 * self.settings.msp_timeout + (self.__max_delay(priority) or 0)
+
+    # Percentiles of the write, first byte and full frame times of the MSP transactions by command ID, in milliseconds:
+    # {cmd: {'write': {'count', 'mean', 'p50', 'p90', 'p99', 'max'}, 'first_byte': {...}, 'frame': {...}}}
+
+    def latency_stats(self):
+
+        return self.latency.stats()
+
+    # Snapshot of the hot path counters: serial bytes in/out, frames parsed, checksum failures, bytes skipped to resync,
+    # RC frames written, UDP telemetry datagrams sent, telemetry ticks and polls missed, stale requests skipped, serial
+    # queue depth and requests waiting for their reply, and flight recorder frames dropped.
+
+    def stats(self):
+
+        worker = self.worker
+        schedulers = [scheduler for scheduler in (self.telemetry_scheduler, self.udp_telemetry_scheduler)
+                      if scheduler is not None]
+
+        return {
+            'serial_bytes_in': self.parser.bytes_received,
+            'serial_bytes_out': self.bytes_written + (worker.bytes_written if worker is not None else 0),
+            'frames': self.parser.frames,
+            'checksum_errors': self.parser.checksum_errors,
+            'error_frames': self.parser.error_frames,
+            'resync_bytes': self.parser.skipped_bytes,
+            'rc_written': self.rc_written,
+            'datagrams_sent': self.datagrams_sent,
+            'telemetry_ticks': self.telemetry_ticks,
+            'telemetry_overruns': sum(scheduler.total_overruns() for scheduler in schedulers),
+            'stale_skipped': worker.skipped if worker is not None else 0,
+            'serial_queue': worker.queue_size() if worker is not None else 0,
+            'serial_in_flight': worker.in_flight() if worker is not None else 0,
+            'recorder_dropped': self.recorder.dropped if self.recorder is not None else 0,
+        }
+
+    # Telemetry requests that could not be sent before telemetry_deadline are skipped, as a newer one will follow
+
+    def __max_delay(self, priority):
+
+        if priority == SerialWorker.SerialWorker.TELEMETRY:
+            return self.settings.telemetry_deadline
+
+    # Reads from the serial port until a reply has been received for every command or the MSP timeout expires. All
+    # the bytes available are read at once and fed to the parser, replies that were not requested are discarded.
+    # Yields (frame, received), where received is the perf_counter_ns() time when its last byte was read.
+
+    def __read_frames(self, cmds):
+
+        pending = set(cmds)
+        deadline = time.perf_counter_ns() + int(self.settings.msp_timeout * 1000000000)
+
+        while pending and time.perf_counter_ns() < deadline:
 
-    # Method used to arm the Drone
+            chunk = self.serial.read(self.serial.in_waiting or 1)
+            received = time.perf_counter_ns()
+
+            for frame in self.parser.feed(chunk, received):
+                if frame.cmd in pending:
+                    pending.discard(frame.cmd)
+                    yield frame, received
+
+        for cmd in pending:
+            serial_log.warning('MSP timeout waiting for command: %d', cmd)
+
+    # Writes a request and waits for its reply without the serial worker. Returns (frame, elapsed), (None, None) if the
+    # reply has not been received before the MSP timeout.
+
+    def __transact(self, cmd, payload=b'', version=None):
+
+        frame = MspParser.create_frame(cmd, payload, b'<', version or self.msp_version)
+        write_start = time.perf_counter_ns()
+        self.serial.write(frame)
+        written = time.perf_counter_ns()
+        self.bytes_written += len(frame)
+
+        if self.recorder is not None:
+            self.recorder.record(FlightRecorder.OUT, cmd, payload)
+
+        deadline = written + int(self.settings.msp_timeout * 1000000000)
+        reply = None
+
+        while reply is None and time.perf_counter_ns() < deadline:
+
+            chunk = self.serial.read(self.serial.in_waiting or 1)
+            received = time.perf_counter_ns()
+
+            for frame in self.parser.feed(chunk, received):
+                if frame.cmd == cmd and reply is None:
+                    self.latency.record(cmd, write_start, written, self.parser.frame_started, received)
+                    reply = (frame, (received - write_start) / 1000000000.0)
+
+        return reply or (None, None)
+
+    # Detects the firmware capabilities, unless the MSP version is set on the settings. Plain MultiWii boards do not
+    # answer MSP_API_VERSION and keep MSP v1. The newer firmwares (Betaflight, iNav, ...) are asked for their variant,
+    # whether they answer MSP v2 frames (16 bits IDs and sizes) and whether they support MSP_MULTIPLE_MSP.
+
+    def __detect_protocol(self):
+
+        if self.settings.msp_version is not None:
+            self.msp_version = self.settings.msp_version
+            return
+
+        reply, _ = self.__transact(MultiWii.API_VERSION, version=1)
+
+        if reply is None or reply.error:
+            log.info('MSP v1, MultiWii firmware')
+            return
+
+        self.api_version = MspMessages.decode(MultiWii.API_VERSION, reply.data)[1:]
+
+        reply, _ = self.__transact(MultiWii.FC_VARIANT, version=1)
+        if reply is not None and not reply.error:
+            self.fc_variant = ''.join(MspMessages.decode(MultiWii.FC_VARIANT, reply.data)[0])
+
+        reply, _ = self.__transact(MultiWii.API_VERSION, version=2)
+        if reply is not None and not reply.error and reply.version == 2:
+            self.msp_version = 2
+
+        if self.settings.multiple_msp:
+            payload = MspMessages.encode(MultiWii.MULTIPLE_MSP, [MultiWii.IDENT])
+            reply, _ = self.__transact(MultiWii.MULTIPLE_MSP, payload)
+            self.multiple_msp = reply is not None and not reply.error and len(reply.data) > 0
+
+        log.info('MSP v%d, %s firmware, API %d.%d%s', self.msp_version, self.fc_variant or 'unknown',
+                 self.api_version[0], self.api_version[1], ', MSP_MULTIPLE_MSP' if self.multiple_msp else '')
+
+    # Method used to arm the Drone. The arming stick sequence is played by the RC stream, then the sticks are held
+    # centered with the minimum throttle. The Drone is not marked as armed if the sequence could not be played.
 
     def arm(self):
 
         if not self.drone.armed:
 
+            profile = []
+
             if self.settings.throttle_yaw:
-                start = time.time()
-                while (time.time() - start) < 2.5:
-                    self.set_rc([1500, 1500, self.settings.max_yaw, self.settings.min_throttle])
+                profile.append((2.5, [1500, 1500, self.settings.max_yaw, self.settings.min_throttle]))
 
             if self.settings.throttle_roll:
-                start = time.time()
-                while (time.time() - start) < 2.5:
-                    self.set_rc([self.settings.max_roll, 1500, 1500, self.settings.min_throttle])
+                profile.append((2.5, [self.settings.max_roll, 1500, 1500, self.settings.min_throttle]))
 
-            self.drone.armed = True
+            if self.__play(profile):
+                self.drone.armed = True
 
     # Method ued to disarm the drone
 
@@ -142,235 +509,263 @@ class MultiWii(object):
 
         if self.drone.armed:
 
+            profile = []
+
             if self.settings.throttle_yaw:
-                start = time.time()
-                while (time.time() - start) < 2.5:
-                    self.set_rc([1500, 1500, self.settings.min_yaw, self.settings.min_throttle])
+                profile.append((2.5, [1500, 1500, self.settings.min_yaw, self.settings.min_throttle]))
 
             if self.settings.throttle_roll:
-                start = time.time()
-                while (time.time() - start) < 2.5:
-                    self.set_rc([self.settings.min_roll, 1500, 1500, self.settings.min_throttle])
+                profile.append((2.5, [self.settings.min_roll, 1500, 1500, self.settings.min_throttle]))
+
+            self.__play(profile)
 
         self.drone.armed = False
 
-    # All methods above are used to get data information, more methods can be added using the same structure as the ones
-    # that are already implemented, and using te MSP getters ID'.
+    # Plays a stick profile on the RC stream and waits for it, at most PROFILE_MARGIN seconds longer than its steps.
+    # With rc_stream the sticks are then held centered with the minimum throttle, without it the stream is stopped so
+    # set_rc is the only source of RC values. Returns False if the profile was not played in time.
 
-    def get_altitude(self):
+    def __play(self, profile):
 
-        total_data, elapsed = self.get_data(MultiWii.ALTITUDE)
+        then = [1500, 1500, 1500, self.settings.min_throttle] if self.settings.rc_stream else None
+        done = self.start_rc_stream().play(profile, then)
+        played = done.wait(sum(duration for duration, _ in profile) + MultiWii.PROFILE_MARGIN)
 
-        self.drone.altitude['estalt'] = total_data[0]
-        self.drone.altitude['vario'] = total_data[1]
-        self.drone.altitude['elapsed'] = round(elapsed, 3)
-        self.drone.altitude['timestamp'] = "%0.2f" % (time.time(),)
+        if not self.settings.rc_stream:
+            self.stop_rc_stream()
 
-        return self.drone.altitude
+        if not played:
+            log.warning('RC profile not played in time')
 
-    def get_attitude(self):
+        return played
 
-        total_data, elapsed = self.get_data(MultiWii.ATTITUDE)
+    # Starts the RC stream, which sends the last RC values at rc_rate (Hz) until stop_rc_stream is called
 
-        self.drone.attitude['angx'] = float(total_data[0] / 10.0)
-        self.drone.attitude['angy'] = float(total_data[1] / 10.0)
-        self.drone.attitude['heading'] = float(total_data[2])
-        self.drone.attitude['elapsed'] = round(elapsed, 3)
-        self.drone.attitude['timestamp'] = "%0.2f" % (time.time(),)
+    def start_rc_stream(self):
 
-        return self.drone.attitude
+        if self.rc_streamer is None:
+            self.rc_streamer = RcStreamer.RcStreamer(self.__send_rc, self.settings.rc_rate,
+                                                     self.settings.rc_hold_timeout)
+            self.rc_streamer.start()
 
-    def get_rc(self):
+        return self.rc_streamer
 
-        total_data, elapsed = self.get_data(MultiWii.RC)
+    def stop_rc_stream(self):
 
-        self.drone.rc_channels['roll'] = total_data[0]
-        self.drone.rc_channels['pitch'] = total_data[1]
-        self.drone.rc_channels['yaw'] = total_data[2]
-        self.drone.rc_channels['throttle'] = total_data[3]
-        self.drone.rc_channels['elapsed'] = round(elapsed, 3)
-        self.drone.rc_channels['timestamp'] = "%0.2f" % (time.time(),)
+        if self.rc_streamer is not None:
+            self.rc_streamer.stop()
+            self.rc_streamer = None
 
-        return self.drone.rc_channels
+    # Getters (get_attitude, get_raw_imu, get_pid_coef, ...) are generated from the MSP registry, see MspMessages.
+    # Each one requests its message, or uses the given reply, and stores the decoded values on the Drone attribute.
+    # With block=False (serial worker only) they return at once a Future whose result is the Drone attribute.
 
-    def get_raw_imu(self):
+    @staticmethod
+    def _create_getter(message):
 
-        total_data, elapsed = self.get_data(MultiWii.RAW_IMU)
+        def getter(self, reply=None, block=True):
 
-        self.drone.raw_imu['accx'] = total_data[0]
-        self.drone.raw_imu['accy'] = total_data[1]
-        self.drone.raw_imu['accz'] = total_data[2]
-        self.drone.raw_imu['gyrx'] = total_data[3]
-        self.drone.raw_imu['gyry'] = total_data[4]
-        self.drone.raw_imu['gyrz'] = total_data[5]
-        self.drone.raw_imu['magx'] = total_data[6]
-        self.drone.raw_imu['magy'] = total_data[7]
-        self.drone.raw_imu['magz'] = total_data[8]
-        self.drone.raw_imu['elapsed'] = round(elapsed, 3)
-        self.drone.raw_imu['timestamp'] = "%0.2f" % (time.time(),)
+            if not block and reply is None:
+                return self.__request_update(message)
 
-        return self.drone.raw_imu
+            if reply is None:
+                reply = self.get_data(message.code)
 
-    def get_motor(self):
+            if reply is not None:
+                total_data, elapsed = reply
+                self.drone.update(message, total_data, elapsed)
 
-        total_data, elapsed = self.get_data(MultiWii.MOTOR)
+            return getattr(self.drone, message.attribute)
 
-        self.drone.motor['m1'] = total_data[0]
-        self.drone.motor['m2'] = total_data[1]
-        self.drone.motor['m3'] = total_data[2]
-        self.drone.motor['m4'] = total_data[3]
-        self.drone.motor['elapsed'] = "%0.3f" % (elapsed,)
-        self.drone.motor['timestamp'] = "%0.2f" % (time.time(),)
+        getter.__name__ = 'get_' + message.name
 
-        return self.drone.motor
+        return getter
 
-    def get_servo(self):
+    def __request_update(self, message):
 
-        total_data, elapsed = self.get_data(MultiWii.SERVO)
+        update = Future()
 
-        self.drone.servo['s1'] = total_data[0]
-        self.drone.servo['s2'] = total_data[1]
-        self.drone.servo['s3'] = total_data[2]
-        self.drone.servo['s4'] = total_data[3]
-        self.drone.servo['elapsed'] = "%0.3f" % (elapsed,)
-        self.drone.servo['timestamp'] = "%0.2f" % (time.time(),)
+        if message.code in self.cache:
+            reply = self.cache.get(message.code)
 
-        return self.drone.servo
+            if reply is not None:
+                update.set_result(self.drone.update(message, *reply))
+                return update
 
-    def get_pid_coef(self):
+            generation = self.cache.generation(message.code)
 
-        total_data, elapsed = self.get_data(MultiWii.PID)
+        def on_reply(future):
+            try:
+                total_data, elapsed = future.result()
+                if message.code in self.cache:
+                    self.cache.put(message.code, (total_data, elapsed), generation)
+                update.set_result(self.drone.update(message, total_data, elapsed))
+            except Exception as err:
+                update.set_exception(err)
 
-        self.drone.PID_coef['rp'] = total_data[0]
-        self.drone.PID_coef['ri'] = total_data[0]
-        self.drone.PID_coef['rd'] = total_data[0]
-        self.drone.PID_coef['pp'] = total_data[0]
-        self.drone.PID_coef['pi'] = total_data[0]
-        self.drone.PID_coef['pd'] = total_data[0]
-        self.drone.PID_coef['yp'] = total_data[0]
-        self.drone.PID_coef['yi'] = total_data[0]
-        self.drone.PID_coef['yd'] = total_data[0]
-        self.drone.PID_coef['elapsed'] = "%0.3f" % (elapsed,)
-        self.drone.PID_coef['timestamp'] = "%0.2f" % (time.time(),)
+        self.request(message.code).add_done_callback(on_reply)
 
-        return self.drone.PID_coef
+        return update
 
     # Sets the values for the ESC of the drone, it's the main method to control it. Needs a 4 short array values
     # [Roll, Yaw, Pitch, Throttle]
 
+    # When rc_stream is enabled on the settings file the values are held by the RC stream and sent at its rate. Raises
+    # ValueError if a value does not fit an unsigned 16 bits word.
+
     def set_rc(self, rc_data):
 
-        self.send_cmd(8, MultiWii.SET_RAW_RC, rc_data)
-        print("Rc values: ", rc_data)
+        RcStreamer.check_channels(rc_data)
 
-    def telemetry_loop(self):
+        if self.settings.rc_stream:
+            self.start_rc_stream().set(rc_data)
+        else:
+            self.__send_rc(rc_data)
 
-        self.telemetry = True
+        rc_log.debug('Rc values: %s', rc_data)
 
-        timer = time.time()
+    def __send_rc(self, rc_data):
 
-        while self.telemetry:
+        self.send_cmd(2 * len(rc_data), MultiWii.SET_RAW_RC, rc_data)
+        self.rc_written += 1
 
-            if time.time() - timer >= self.settings.TELEMETRY_TIME:
+    # Configuration setters. Values are given in the order of the fields of the message (e.g. MspMessages.PID_FIELDS),
+    # a snapshot of its getter can be given too. Raise ValueError if the number of values does not match the fields of
+    # the message. The cached getters they change are invalidated.
 
-                if self.settings.MSP_ALTITUDE:
-                    self.get_altitude()
+    def set_pid(self, pid):
 
-                if self.settings.MSP_ATTITUDE:
-                    self.get_attitude()
+        self.__send_setter(MultiWii.SET_PID, pid)
 
-                if self.settings.MSP_RAW_IMU:
-                    self.get_raw_imu()
+    def set_rc_tuning(self, rc_tuning):
 
-                if self.settings.MSP_RC:
-                    self.get_rc()
+        self.__send_setter(MultiWii.SET_RC_TUNING, rc_tuning)
 
-                if self.settings.MSP_MOTOR:
-                    self.get_motor()
+    def set_misc(self, misc):
 
-                if self.settings.MSP_SERVO:
-                    self.get_servo()
+        self.__send_setter(MultiWii.SET_MISC, misc)
 
-                timer = time.time()
+    # Box activations, one value per box (see get_boxnames)
 
-    # UDP communication methods, are used to send data information to the IP and Port configured on the settings file.
+    def set_box(self, box):
 
-    def udp_get_altitude(self):
+        self.__send_setter(MultiWii.SET_BOX, box)
 
-        if not self.udp_server_started:
-            self.__start_udp_server()
+    def reset_conf(self):
 
-        altitude = self.get_altitude()
-        data = [altitude['estalt'], altitude['vario']]
+        self.__send_setter(MultiWii.RESET_CONF, [])
 
-        print("SEND ALTITUDE")
-        self.sock.sendto(MultiWii.__create_big_endian_package(self.ALTITUDE, 4, data), self.settings.address)
+    def __send_setter(self, code, values):
 
-    def udp_get_attitude(self):
+        message = MspMessages.get(code)
 
-        if not self.udp_server_started:
-            self.__start_udp_server()
+        if isinstance(message, MspMessages.MspArrayMessage):
+            # A Box snapshot holds the activations on its values field
+            values = list(getattr(values, 'values', values))
+            self.send_cmd(2 * len(values), code, values)
+        else:
+            # A snapshot also holds its elapsed and timestamp fields
+            if hasattr(values, '_fields'):
+                values = [getattr(values, field) for field in message.fields]
 
-        attitude = self.get_attitude()
-        data = [attitude['angx'], attitude['angy'], attitude['heading']]
+            values = list(values)
 
-        print("SEND ATTITUDE")
-        self.sock.sendto(self.__create_big_endian_package(self.ATTITUDE, 6, data),
-                         self.settings.address)
+            if len(values) != len(message.fields):
+                raise ValueError('%s takes %d values, %d given' % (message.name, len(message.fields), len(values)))
 
-    def udp_get_raw_imu(self):
+            self.send_cmd(message.size, code, values)
 
-        if not self.udp_server_started:
-            self.__start_udp_server()
+    # Returns the MSP getter IDs enabled on the settings file (MSP_ALTITUDE, MSP_ATTITUDE, ...)
 
-        raw_imu = self.get_raw_imu()
-        data = [raw_imu["accx"], raw_imu["accy"], raw_imu["accz"], raw_imu["gyrx"], raw_imu["gyry"],
-                raw_imu["gyrz"], raw_imu["magx"], raw_imu["magy"], raw_imu["magz"]]
+    def telemetry_cmds(self):
 
-        print("SEND RAW_IMU")
-        self.sock.sendto(self.__create_big_endian_package(self.RAW_IMU, 18, data), self.settings.address)
+        return [cmd for cmd, flag in MultiWii.TELEMETRY_FLAGS if getattr(self.settings, flag)]
 
-    def udp_get_rc(self):
+    # Returns the polling rate of each enabled getter, {cmd: Hz}, from the <flag>_RATE settings
 
-        if not self.udp_server_started:
-            self.__start_udp_server()
+    def telemetry_rates(self):
 
-        rc = self.get_rc()
-        data = [rc["roll"], rc["pitch"], rc["yaw"], rc["throttle"]]
+        return dict((cmd, getattr(self.settings, flag + '_RATE')) for cmd, flag in MultiWii.TELEMETRY_FLAGS
+                    if getattr(self.settings, flag))
 
-        print("SEND RC")
-        self.sock.sendto(self.__create_big_endian_package(self.RC, 8, data), self.settings.address)
+    # Polls the enabled getters, each one at its own rate, until stop_telemetry is called
 
-    def udp_get_motor(self):
+    def telemetry_loop(self):
 
-        if not self.udp_server_started:
-            self.__start_udp_server()
+        self.telemetry = True
+        self.telemetry_scheduler = TelemetryScheduler.TelemetryScheduler(self.telemetry_rates())
+
+        getters = {MultiWii.ALTITUDE: self.get_altitude, MultiWii.ATTITUDE: self.get_attitude,
+                   MultiWii.RAW_IMU: self.get_raw_imu, MultiWii.RC: self.get_rc, MultiWii.MOTOR: self.get_motor,
+                   MultiWii.SERVO: self.get_servo, MultiWii.PID: self.get_pid_coef}
 
-        motor = self.get_motor()
-        data = [motor['m1'], motor['m2'], motor['m3'], motor['m4']]
-        self.sock.sendto(self.__create_big_endian_package(self.MOTOR, 8, data), self.settings.address)
+        while self.telemetry:
 
-    def udp_get_servo(self):
+            cmds = self.telemetry_scheduler.wait()
 
-        if not self.udp_server_started:
-            self.__start_udp_server()
+            if cmds:
+                replies = self.get_many(cmds, SerialWorker.SerialWorker.TELEMETRY)
+
+                for cmd, reply in replies.items():
+                    getters[cmd](reply)
+
+                self.telemetry_ticks += 1
+
+    # UDP communication methods, are used to send data information to the IP and Port configured on the settings file.
+
+    def udp_get_altitude(self, reply=None):
+
+        self.__udp_send(MultiWii.ALTITUDE, reply)
+
+    def udp_get_attitude(self, reply=None):
+
+        self.__udp_send(MultiWii.ATTITUDE, reply)
+
+    def udp_get_raw_imu(self, reply=None):
+
+        self.__udp_send(MultiWii.RAW_IMU, reply)
+
+    def udp_get_rc(self, reply=None):
+
+        self.__udp_send(MultiWii.RC, reply)
+
+    def udp_get_motor(self, reply=None):
+
+        self.__udp_send(MultiWii.MOTOR, reply)
+
+    def udp_get_servo(self, reply=None):
+
+        self.__udp_send(MultiWii.SERVO, reply)
 
-        servo = self.get_servo()
-        data = [servo['s1'], servo['s2'], servo['s3'], servo['s4']]
-        self.sock.sendto(self.__create_big_endian_package(self.SERVO, 8, data), self.settings.address)
+    def udp_get_pid_coef(self, reply=None):
 
-    def udp_get_pid_coef(self):
+        self.__udp_send(MultiWii.PID, reply)
+
+    def __udp_send(self, cmd, reply):
 
         if not self.udp_server_started:
             self.__start_udp_server()
 
-        pid = self.get_pid_coef()
-        data = [pid["rp"], pid["ri"], pid["rd"], pid["pp"], pid["pi"],
-                pid["pd"], pid["yp"], pid["yi"], pid["yd"]]
+        data = self.__udp_values(cmd, reply)
+
+        buffer = TelemetryBundle.package_buffer(4 + 2 * len(data))
+        end = TelemetryBundle.pack_package(buffer, 0, cmd, data)
+
+        udp_log.debug('Send %d: %s', cmd, data)
+        self.__send_datagram(memoryview(buffer)[:end])
+
+    # Requests a getter, or uses the given reply, and returns its UDP_FIELDS values
+
+    def __udp_values(self, cmd, reply):
+
+        message = MspMessages.get(cmd)
+        values = getattr(self, 'get_' + message.name)(reply)
 
-        self.sock.sendto(self.__create_big_endian_package(self.PID, 18, data), self.settings.address)
+        return message.raw_values(values, MultiWii.UDP_FIELDS[cmd])
 
-    # Sends constantly the desired telemetry data to the device specified on the settings file.
+    # Sends constantly the desired telemetry data to the device specified on the settings file. With telemetry_bundle
+    # set, all the getters polled on a tick are sent on a single datagram (see TelemetryBundle). With telemetry_delta
+    # set, that datagram is delta encoded against the previous ones (see TelemetryDelta).
 
     def udp_telemetry_loop(self, address, sock):
 
@@ -379,36 +774,63 @@ class MultiWii(object):
         if self.udp_server_started:
 
             self.udp_telemetry = True
+            self.udp_telemetry_scheduler = TelemetryScheduler.TelemetryScheduler(self.telemetry_rates())
+            encoder = None
+            sequence = 0
 
-            timer = time.time()
+            if self.settings.telemetry_delta:
+                encoder = TelemetryDelta.DeltaEncoder(self.settings.telemetry_keyframe_interval)
+
+            udp_getters = {MultiWii.ALTITUDE: self.udp_get_altitude, MultiWii.ATTITUDE: self.udp_get_attitude,
+                           MultiWii.RAW_IMU: self.udp_get_raw_imu, MultiWii.RC: self.udp_get_rc,
+                           MultiWii.MOTOR: self.udp_get_motor, MultiWii.SERVO: self.udp_get_servo,
+                           MultiWii.PID: self.udp_get_pid_coef}
 
             while self.udp_telemetry:
 
-                if time.time() - timer >= self.settings.TELEMETRY_TIME:
+                cmds = self.udp_telemetry_scheduler.wait()
 
-                    if self.settings.MSP_ALTITUDE:
-                        self.udp_get_altitude()
+                if cmds:
+                    replies = self.get_many(cmds, SerialWorker.SerialWorker.TELEMETRY)
 
-                    if self.settings.MSP_ATTITUDE:
-                        self.udp_get_attitude()
+                    if encoder is not None:
+                        if replies:
+                            self.__send_delta(replies, encoder, sequence)
+                            sequence += 1
+                    elif self.settings.telemetry_bundle:
+                        if replies:
+                            self.__send_bundle(replies)
+                    else:
+                        for cmd, reply in replies.items():
+                            udp_getters[cmd](reply)
 
-                    if self.settings.MSP_RAW_IMU:
-                        self.udp_get_raw_imu()
+                    self.telemetry_ticks += 1
+        else:
+            return self.udp_server_started
 
-                    if self.settings.MSP_RC:
-                        self.udp_get_rc()
+    def __send_bundle(self, replies):
 
-                    if self.settings.MSP_MOTOR:
-                        self.udp_get_motor()
+        records = [(cmd, self.__udp_values(cmd, reply)) for cmd, reply in replies.items()]
+        buffer = TelemetryBundle.package_buffer(TelemetryBundle.bundle_size(records))
+        end = TelemetryBundle.pack_bundle(buffer, self.telemetry_ticks, time.monotonic_ns() // 1000000, records)
 
-                    if self.settings.MSP_SERVO:
-                        self.get_servo()
+        udp_log.debug('Send bundle: %s', records)
+        self.__send_datagram(memoryview(buffer)[:end])
 
-                    timer = time.time()
-        else:
-            return self.udp_server_started
+    def __send_delta(self, replies, encoder, sequence):
 
-    def __start_udp_server(self, address, sock):
+        records = [(cmd, self.__udp_values(cmd, reply)) for cmd, reply in replies.items()]
+
+        udp_log.debug('Send delta bundle: %s', records)
+        self.__send_datagram(encoder.encode(sequence, time.monotonic_ns() // 1000000, records))
+
+    def __send_datagram(self, package):
+
+        self.sock.sendto(package, self.settings.address)
+        self.datagrams_sent += 1
+        self.datagram_bytes_sent += len(package)
+
+    def __start_udp_server(self, address="", sock=""):
 
         if not self.udp_server_started:
 
@@ -421,18 +843,20 @@ class MultiWii(object):
                 else:
                     self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-                print("Socket creation: Socket created!")
+                log.info('Socket creation: Socket created!')
                 self.udp_server_started = True
-                print("Server started!")
+                log.info('Server started!')
 
             except socket.error as err:
-                print("Error starting server: {}".format(err))
+                log.error('Error starting server: %s', err)
         else:
-            print("Server already started!")
+            log.info('Server already started!')
 
     def stop_telemetry(self):
         self.telemetry = False
-        print("Telemetry stopped!")
+        if self.telemetry_scheduler is not None:
+            self.telemetry_scheduler.stop()
+        log.info('Telemetry stopped!')
 
     def close_udp_server(self):
 
@@ -443,24 +867,10 @@ class MultiWii(object):
     def stop_udp_telemetry(self):
 
         self.udp_telemetry = False
-        print("UDP telemetry stopped!")
-
-    @staticmethod
-    def __create_little_endian_package(code, size, data):
-
-        code = struct.pack('<h', code)
-        size = struct.pack('<h', size)
-        data = struct.pack('<'+'h' * len(data), *data)
-        package = code + size + data
-
-        return package
-
-    @staticmethod
-    def __create_big_endian_package(code, size, data):
+        if self.udp_telemetry_scheduler is not None:
+            self.udp_telemetry_scheduler.stop()
+        log.info('UDP telemetry stopped!')
 
-        code = struct.pack('>h', code)
-        size = struct.pack('>h', size)
-        data = struct.pack('>' + 'h' * len(data), *data)
-        package = code + size + data
 
-        return package
+for _message in MspMessages.GETTERS:
+    setattr(MultiWii, 'get_' + _message.name, MultiWii._create_getter(_message))
@@ -3,7 +3,7 @@ import serial
 
 class Settings(object):
 
-    def __init__(self):
+    def __init__(self, port_name="COM4"):
 
         # Decides which functions will be executed in the loop method of the MultiWii
         self.MSP_PID = False
@@ -14,6 +14,24 @@ class Settings(object):
         self.MSP_ATTITUDE = False
         self.MSP_ALTITUDE = True
         self.TELEMETRY_TIME = 1
+        # The UDP telemetry loop sends all the messages polled on a tick on a single datagram (telemetry bundle)
+        self.telemetry_bundle = False
+        # The telemetry bundles are delta encoded, with a full keyframe of each message every keyframe interval
+        self.telemetry_delta = False
+        self.telemetry_keyframe_interval = 10
+
+        # Polling rate (Hz) of each message enabled above, used by the telemetry loops
+        self.MSP_PID_RATE = 1
+        self.MSP_RAW_IMU_RATE = 25
+        self.MSP_SERVO_RATE = 10
+        self.MSP_MOTOR_RATE = 10
+        self.MSP_RC_RATE = 10
+        self.MSP_ATTITUDE_RATE = 50
+        self.MSP_ALTITUDE_RATE = 5
+
+        # Telemetry history (needs numpy): rows kept per message, either a number for every getter or a dict by MSP
+        # code, e.g. {102: 5000, 108: 3000} for a minute or two of RAW_IMU/ATTITUDE. 0 disables it.
+        self.history_capacity = 0
 
         # Arm/Disarm configuration, used to define which kind of sequence/values are needed to arm/disarm the drone.
 
@@ -25,6 +43,12 @@ class Settings(object):
         self.min_yaw = 900
         self.min_roll = 900
 
+        # RC stream: the RC values are sent at a fixed rate (Hz), the last ones are held until rc_hold_timeout seconds
+        # without updates. Arm/disarm sequences always use it.
+        self.rc_stream = True
+        self.rc_rate = 50
+        self.rc_hold_timeout = 1.0
+
         # Raspberry Pi UDP Server attributes: Ip address and port of telemetry receiver.
         self.ip_address = "192.168.0.164"
         self.port = 4446
@@ -32,18 +56,41 @@ class Settings(object):
 
         # Serial port configuration (change port name to the port where the MultiWii is connected)
         self.serial_port = serial.Serial()
-        self.serial_port.port = "COM4"
+        self.serial_port.port = port_name
         self.serial_port.baudrate = 115200
         self.serial_port.bytesize = serial.EIGHTBITS
         self.serial_port.parity = serial.PARITY_NONE
         self.serial_port.stopbits = serial.STOPBITS_ONE
-        self.serial_port.timeout = 0
+        self.serial_port.timeout = 0.01
         self.serial_port.xonxoff = False
         self.serial_port.rtscts = False
         self.serial_port.dsrdtr = False
         self.serial_port.write_timeout = 0
         self.wakeup = 10
         self.timeMSP = 0.02
+        # Maximum time to wait for the reply of a MSP request
+        self.msp_timeout = 0.5
+        # Owns the serial port with a dedicated thread, needed when several threads use the MultiWii (server)
+        self.serial_worker = True
+        # Maximum number of queries/telemetry requests waiting for their reply, control commands are never delayed
+        self.serial_window = 4
+        # MSP framing: None detects the firmware capabilities at connect, 1 forces MSP v1 (plain MultiWii, no detection
+        # requests) and 2 forces MSP v2. Several getters are read with a single MSP_MULTIPLE_MSP request when
+        # multiple_msp is True and the firmware supports it.
+        self.msp_version = None
+        self.multiple_msp = True
+        # Telemetry requests still queued after this time are skipped as stale
+        self.telemetry_deadline = 0.1
+
+        # Seconds the replies of the configuration messages are cached, by MSP code: IDENT, RC_TUNING, PID, BOX, MISC,
+        # BOXNAMES, PIDNAMES and BOXIDS. The setters invalidate the messages they change. Remove a code to not cache it.
+        self.config_ttl = {100: 300, 111: 60, 112: 60, 113: 60, 114: 60, 116: 300, 117: 300, 119: 300}
+
+        # Flight recorder: every MSP frame sent and received is appended to binary logs on recorder_directory, a new
+        # file is started every recorder_max_bytes
+        self.flight_recorder = False
+        self.recorder_directory = 'logs'
+        self.recorder_max_bytes = 16 * 1024 * 1024
 
 
 
@@ -0,0 +1,142 @@
+import threading
+import time
+
+from collections import deque
+
+from src.Multiwii import Logger
+
+log = Logger.get_logger('RcStreamer')
+# Send errors, at most one per second
+send_log = Logger.RateLimitedLogger(log)
+
+
+# Sends the RC channels to the flight controller at a fixed rate. Holds the last stick vector and keeps sending it
+# between updates, so the serial bandwidth used by the control does not depend on how often the ground station sends
+# it. Timed profiles (e.g. the arm/disarm stick sequences) are played on top of it, and the held vector is dropped
+# after hold_timeout seconds without updates to let the flight controller failsafe act if the ground link is lost.
+
+class RcStreamer(object):
+
+    def __init__(self, send, rate=50, hold_timeout=1.0):
+
+        self.send = send
+        self.period = 1.0 / rate
+        self.hold_timeout = hold_timeout
+        self.running = False
+        self.frames = 0
+
+        self.__rc_data = None
+        self.__updated = 0.0
+        self.__profiles = deque()
+        self.__step_end = None
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+
+        if not self.running:
+            self.running = True
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__loop, name='RcStreamer', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+
+        self.running = False
+        self.__stop.set()
+
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+        with self.__lock:
+            for steps, then, done in self.__profiles:
+                done.set()
+            self.__profiles.clear()
+            self.__step_end = None
+
+    # Sets the stick vector sent on every tick, None stops sending
+
+    def set(self, rc_data):
+
+        self.__rc_data = list(rc_data) if rc_data is not None else None
+        self.__updated = time.monotonic()
+
+    # Plays a profile: a list of (duration, rc_data) steps sent instead of the held vector. When it finishes, then is
+    # held if given. Returns an Event that is set once the profile has been played.
+
+    def play(self, profile, then=None):
+
+        done = threading.Event()
+
+        with self.__lock:
+            self.__profiles.append((deque(profile), then, done))
+
+        return done
+
+    def __loop(self):
+
+        next_tick = time.monotonic()
+
+        while self.running:
+
+            rc_data = self.__current(next_tick)
+
+            if rc_data is not None:
+                # A failed send must not end the stream: the next tick sends again
+                try:
+                    self.send(rc_data)
+                    self.frames += 1
+                except Exception as err:
+                    send_log.warning('RC stream send error: %s', err)
+
+            next_tick += self.period
+            now = time.monotonic()
+
+            if next_tick < now:
+                next_tick = now
+
+            self.__stop.wait(next_tick - now)
+
+    # Returns the vector to send on this tick: the current profile step, or the held vector if it is not too old
+
+    def __current(self, now):
+
+        with self.__lock:
+
+            while self.__profiles:
+
+                steps, then, done = self.__profiles[0]
+
+                if steps:
+                    duration, rc_data = steps[0]
+
+                    if self.__step_end is None:
+                        self.__step_end = now + duration
+
+                    if now < self.__step_end:
+                        return rc_data
+
+                    steps.popleft()
+                    self.__step_end = None
+                    continue
+
+                self.__profiles.popleft()
+                if then is not None:
+                    self.set(then)
+                done.set()
+
+        if self.__rc_data is not None and now - self.__updated < self.hold_timeout:
+            return self.__rc_data
+
+        return None
+
+
+# RC channels are sent as unsigned 16 bits words (SET_RAW_RC), raises ValueError if a value does not fit
+
+def check_channels(rc_data):
+
+    for value in rc_data:
+        if not 0 <= value <= 0xFFFF:
+            raise ValueError('RC channel value out of range: %s' % value)
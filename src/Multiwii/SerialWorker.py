@@ -0,0 +1,252 @@
+import threading
+import time
+import serial
+
+from collections import deque, namedtuple
+from concurrent.futures import Future
+
+from src.Multiwii import MspParser, MspMessages, FlightRecorder
+
+# Times are perf_counter_ns() values: start when submitted, write_start and written when the write began and ended
+# (None until then)
+SerialRequest = namedtuple('SerialRequest', ['code', 'payload', 'frame', 'future', 'reply', 'priority', 'start',
+                                             'deadline', 'expires', 'write_start', 'written'])
+
+
+# Owns the serial port on a dedicated thread. Requests are submitted from any thread and their results are returned as
+# futures, so several consumers (control, telemetry, one-shot queries) can share the link without interleaving bytes.
+# The queued requests are written together and the replies are matched to the requests by their command ID.
+#
+# Requests are scheduled by priority: control commands (arm/disarm/RC) are written as soon as they are queued, then the
+# one-shot queries and last the periodic telemetry. At most window queries/telemetry requests wait for their reply at
+# the same time, so control commands never queue behind a whole telemetry sweep, and requests that could not be
+# written before they expire (stale telemetry) are skipped.
+
+class SerialWorker(object):
+
+    # Priority classes
+    CONTROL = 0
+    QUERY = 1
+    TELEMETRY = 2
+
+    def __init__(self, serial_port, parser, timeout, window=4):
+
+        self.serial = serial_port
+        self.parser = parser
+        self.timeout = timeout
+        self.window = window
+        self.running = False
+        self.skipped = 0
+        self.bytes_written = 0
+        # MSP framing of the requests (1 or 2), set once the firmware capabilities are known
+        self.msp_version = 1
+        # FlightRecorder where the written requests are recorded, if any
+        self.recorder = None
+        # LatencyStats where the timing of every transaction is recorded, if any
+        self.latency = None
+
+        self.__queues = (deque(), deque(), deque())
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__pending = {}
+        self.__in_flight = 0
+
+    def start(self):
+
+        if not self.running:
+            self.running = True
+            self.__thread = threading.Thread(target=self.__loop, name='SerialWorker', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+
+        self.running = False
+
+        with self.__condition:
+            self.__condition.notify()
+
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    # Queues a MSP command. When reply is True the future result is (total_data, elapsed) once the reply is received,
+    # otherwise it is None once the command has been written. Timeout overrides the default reply timeout, and
+    # max_delay is the time the request can wait on the queue before it is skipped as stale (None waits forever).
+    # Version overrides the MSP framing of the request.
+
+    def submit(self, code, data=None, reply=True, timeout=None, priority=QUERY, max_delay=None, version=None):
+
+        future = Future()
+        payload = MspMessages.encode(code, data) if data else b''
+        start = time.perf_counter_ns()
+        deadline = start + int((timeout if timeout is not None else self.timeout) * 1000000000)
+        expires = start + int(max_delay * 1000000000) if max_delay is not None else None
+
+        frame = MspParser.create_frame(code, payload, b'<', version or self.msp_version)
+        request = SerialRequest(code, payload, frame, future, reply, priority, start, deadline, expires, None, None)
+
+        with self.__condition:
+            self.__queues[priority].append(request)
+            self.__condition.notify()
+
+        return future
+
+    def queue_size(self):
+
+        return sum(len(requests) for requests in self.__queues)
+
+    # Queries and telemetry requests written that are waiting for their reply
+
+    def in_flight(self):
+
+        return self.__in_flight
+
+    def __loop(self):
+
+        while self.running:
+
+            self.__send_requests()
+
+            if self.__pending:
+                self.__read_replies()
+                self.__expire()
+
+        self.__cancel_pending()
+
+    # Writes the queued requests allowed by the window, by priority, with a single serial write. Blocks for a while if
+    # there is nothing to read.
+
+    def __send_requests(self):
+
+        requests = []
+        now = time.perf_counter_ns()
+
+        with self.__condition:
+
+            if not self.__pending and not self.queue_size():
+                self.__condition.wait(0.1)
+
+            control, query, telemetry = self.__queues
+
+            while control:
+                requests.append(control.popleft())
+
+            in_flight = self.__in_flight
+            for queue in (query, telemetry):
+                while queue and in_flight < self.window:
+                    request = queue.popleft()
+
+                    if request.expires is not None and request.expires <= now:
+                        self.skipped += 1
+                        if request.future.set_running_or_notify_cancel():
+                            request.future.set_exception(TimeoutError('Stale MSP request skipped: ' +
+                                                                      str(request.code)))
+                        continue
+
+                    requests.append(request)
+                    in_flight += 1
+
+        requests = [request for request in requests if request.future.set_running_or_notify_cancel()]
+
+        if not requests:
+            return
+
+        try:
+            package = b''.join(request.frame for request in requests)
+            write_start = time.perf_counter_ns()
+            self.serial.write(package)
+            written = time.perf_counter_ns()
+            self.bytes_written += len(package)
+
+        except (serial.SerialException, ValueError) as err:
+            for request in requests:
+                request.future.set_exception(err)
+            return
+
+        if self.recorder is not None:
+            for request in requests:
+                self.recorder.record(FlightRecorder.OUT, request.code, request.payload)
+
+        for request in requests:
+            if request.reply:
+                request = request._replace(write_start=write_start, written=written)
+                self.__pending.setdefault(request.code, deque()).append(request)
+                if request.priority != SerialWorker.CONTROL:
+                    self.__in_flight += 1
+            else:
+                if self.latency is not None:
+                    self.latency.record(request.code, write_start, written)
+                request.future.set_result(None)
+
+    def __read_replies(self):
+
+        try:
+            chunk = self.serial.read(self.serial.in_waiting or 1)
+
+        except serial.SerialException as err:
+            self.__fail_pending(err)
+            return
+
+        received = time.perf_counter_ns()
+
+        for frame in self.parser.feed(chunk, received):
+
+            requests = self.__pending.get(frame.cmd)
+
+            if not requests:
+                continue
+
+            request = self.__pop_pending(frame.cmd)
+
+            if self.latency is not None:
+                self.latency.record(frame.cmd, request.write_start, request.written, self.parser.frame_started,
+                                    received)
+
+            if frame.error:
+                request.future.set_exception(ValueError('MSP error reply for command: ' + str(frame.cmd)))
+            else:
+                request.future.set_result((MspMessages.decode(frame.cmd, frame.data),
+                                           (received - request.start) / 1000000000.0))
+
+    # Fails the requests whose reply has not been received before their deadline
+
+    def __expire(self):
+
+        now = time.perf_counter_ns()
+
+        for code in list(self.__pending):
+
+            while code in self.__pending and self.__pending[code][0].deadline <= now:
+                request = self.__pop_pending(code)
+                request.future.set_exception(TimeoutError('MSP timeout waiting for command: ' + str(code)))
+
+    def __pop_pending(self, code):
+
+        requests = self.__pending[code]
+        request = requests.popleft()
+
+        if not requests:
+            del self.__pending[code]
+
+        if request.priority != SerialWorker.CONTROL:
+            self.__in_flight -= 1
+
+        return request
+
+    def __fail_pending(self, err):
+
+        for requests in self.__pending.values():
+            for request in requests:
+                request.future.set_exception(err)
+
+        self.__pending.clear()
+        self.__in_flight = 0
+
+    def __cancel_pending(self):
+
+        self.__fail_pending(RuntimeError('Serial worker stopped'))
+
+        with self.__condition:
+            for requests in self.__queues:
+                while requests:
+                    requests.popleft().future.cancel()
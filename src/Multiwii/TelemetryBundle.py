@@ -0,0 +1,135 @@
+import struct
+import threading
+
+# Package code of a telemetry bundle, on the Android APP / Raspberry protocol
+CODE = 125
+
+# Code and size of the package, sequence number and timestamp of the tick
+HEADER = struct.Struct('>2h2I')
+# Code and size of each record
+RECORD = struct.Struct('>2h')
+
+__words = {}
+# Package buffer of each thread, see package_buffer
+__buffers = threading.local()
+
+
+# Packs every sample of a telemetry tick on a single datagram, instead of one datagram per sensor: the header is
+# followed by one record per sample, with the same code, size and big endian 16 bits values as the single sensor
+# packages, so clients parse each record as they parse those. Sequence is incremented by each bundle sent to a client,
+# a gap means that bundles have been lost. Timestamp is the monotonic time of the tick in milliseconds, both wrap
+# around at 32 bits.
+#
+# Records is a list of (code, values).
+
+def create_bundle(sequence, timestamp, records):
+
+    package = bytearray(bundle_size(records))
+    pack_bundle(package, sequence, timestamp, records)
+
+    return package
+
+
+# Packs a bundle at the start of buffer, which must have bundle_size(records) bytes at least. Returns its size.
+
+def pack_bundle(buffer, sequence, timestamp, records):
+
+    offset = HEADER.size
+
+    for code, values in records:
+        offset = pack_package(buffer, offset, code, values)
+
+    HEADER.pack_into(buffer, 0, CODE, offset - 4, sequence & 0xFFFFFFFF, timestamp & 0xFFFFFFFF)
+
+    return offset
+
+
+def bundle_size(records):
+
+    return HEADER.size + sum(RECORD.size + 2 * len(values) for _, values in records)
+
+
+# Reference decoder for the clients: returns (sequence, timestamp, [(code, values), ...]). Raises ValueError if the
+# package is not a complete bundle.
+
+def parse_bundle(package):
+
+    if len(package) < HEADER.size:
+        raise ValueError('Telemetry bundle too short: %d bytes' % len(package))
+
+    code, size, sequence, timestamp = HEADER.unpack_from(package)
+
+    if code != CODE or len(package) < size + 4:
+        raise ValueError('Not a complete telemetry bundle')
+
+    records = []
+    offset = HEADER.size
+    end = size + 4
+
+    while offset < end:
+
+        if offset + RECORD.size > end:
+            raise ValueError('Truncated telemetry bundle record')
+
+        record_code, record_size = RECORD.unpack_from(package, offset)
+        offset += RECORD.size
+
+        if offset + record_size > end:
+            raise ValueError('Truncated telemetry bundle record')
+
+        records.append((record_code, words(record_size // 2).unpack_from(package, offset)))
+        offset += record_size
+
+    return sequence, timestamp, records
+
+
+# Single sensor packages of the Android APP / Raspberry protocol: code, size and big endian 16 bits values. Packs one
+# at offset of buffer and returns its end. Size is the one given on the package, 2 * len(values) by default.
+
+def pack_package(buffer, offset, code, values, size=None):
+
+    RECORD.pack_into(buffer, offset, code, 2 * len(values) if size is None else size)
+    words(len(values)).pack_into(buffer, offset + RECORD.size, *values)
+
+    return offset + RECORD.size + 2 * len(values)
+
+
+# Returns (code, values) of the package received on the first length bytes of buffer. Raises ValueError if the size
+# of the package does not match them.
+
+def unpack_package(buffer, length):
+
+    if length < RECORD.size:
+        raise ValueError('Package too short: %d bytes' % length)
+
+    code, size = RECORD.unpack_from(buffer)
+
+    if size < 0 or size + RECORD.size > length:
+        raise ValueError('Package %d truncated: size %d, %d bytes received' % (code, size, length))
+
+    return code, words(size // 2).unpack_from(buffer, RECORD.size)
+
+
+# Preallocated buffer of the calling thread, of size bytes at least. Packages are packed on it and sent from a
+# memoryview of it, so sending the telemetry does not allocate a new bytes object per package. It is reused by the next
+# package of the thread, the package must have been sent by then.
+
+def package_buffer(size):
+
+    buffer = getattr(__buffers, 'buffer', None)
+
+    if buffer is None or len(buffer) < size:
+        buffer = __buffers.buffer = bytearray(max(size, 512))
+
+    return buffer
+
+
+def words(count):
+
+    words_struct = __words.get(count)
+
+    if words_struct is None:
+        words_struct = struct.Struct('>%dh' % count)
+        __words[count] = words_struct
+
+    return words_struct
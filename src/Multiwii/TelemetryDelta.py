@@ -0,0 +1,210 @@
+from src.Multiwii import TelemetryBundle
+
+# Package code of a delta encoded telemetry bundle, on the Android APP / Raspberry protocol
+CODE = 126
+
+# A getter is sent in full at least once every KEYFRAME_INTERVAL records
+KEYFRAME_INTERVAL = 10
+
+
+# Delta encoding of the telemetry bundles, for low bandwidth links: most values change by small amounts between ticks,
+# so instead of full 16 bits values each record carries the difference with the previous values sent of its getter.
+#
+# The package has the header of a telemetry bundle (code, size, sequence and timestamp) followed by one record per
+# sample. Each record starts with the varint (code << 1 | delta) and the varint count of values. Keyframe records
+# (delta 0) follow with the zigzag varint of each value, delta records with a bitmap of the values that changed (a bit
+# per value, least significant bit first) and the zigzag varint difference of each changed value.
+#
+# Each getter is sent as a keyframe on its first record and then every keyframe_interval records, so a client that
+# lost a package (a gap on the sequence) recovers each getter on its next keyframe.
+
+class DeltaEncoder(object):
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+
+        self.keyframe_interval = keyframe_interval
+        self.keyframes = 0
+        self.deltas = 0
+
+        self.__references = {}
+        self.__since_keyframe = {}
+
+    # Records is a list of (code, values). The package is encoded on the package buffer of the thread (see
+    # TelemetryBundle.package_buffer) and a memoryview of it is returned, valid until the next package of the thread.
+    # The header is packed once the size is known.
+
+    def encode(self, sequence, timestamp, records):
+
+        buffer = TelemetryBundle.package_buffer(max_size(records))
+        offset = TelemetryBundle.HEADER.size
+
+        for code, values in records:
+
+            values = [int(value) for value in values]
+            reference = self.__references.get(code)
+            since_keyframe = self.__since_keyframe.get(code, 0)
+
+            if reference is None or len(reference) != len(values) or since_keyframe + 1 >= self.keyframe_interval:
+                offset = write_varint(buffer, offset, code << 1)
+                offset = write_varint(buffer, offset, len(values))
+                for value in values:
+                    offset = write_varint(buffer, offset, zigzag(value))
+                self.__since_keyframe[code] = 0
+                self.keyframes += 1
+
+            else:
+                offset = write_varint(buffer, offset, code << 1 | 1)
+                offset = write_varint(buffer, offset, len(values))
+                bitmap = offset
+                offset += (len(values) + 7) // 8
+                buffer[bitmap:offset] = bytes(offset - bitmap)
+                for i, (value, previous) in enumerate(zip(values, reference)):
+                    if value != previous:
+                        buffer[bitmap + (i >> 3)] |= 1 << (i & 7)
+                        offset = write_varint(buffer, offset, zigzag(value - previous))
+                self.__since_keyframe[code] = since_keyframe + 1
+                self.deltas += 1
+
+            self.__references[code] = values
+
+        TelemetryBundle.HEADER.pack_into(buffer, 0, CODE, offset - 4, sequence & 0xFFFFFFFF, timestamp & 0xFFFFFFFF)
+
+        return memoryview(buffer)[:offset]
+
+    # Sends every getter as a keyframe on its next record
+
+    def reset(self):
+
+        self.__references.clear()
+        self.__since_keyframe.clear()
+
+
+# Reference decoder for the clients. Keeps the last values of each getter to apply the deltas to. When a gap is found
+# on the sequence numbers (lost packages) the values are no longer known, and the delta records of each getter are
+# skipped until its next keyframe.
+
+class DeltaDecoder(object):
+
+    def __init__(self):
+
+        self.lost = 0
+        self.skipped = 0
+
+        self.__values = {}
+        self.__sequence = None
+
+    # Returns (sequence, timestamp, [(code, values), ...]) with the records that could be decoded. Raises ValueError if
+    # the package is not a complete delta bundle.
+
+    def decode(self, package):
+
+        if len(package) < TelemetryBundle.HEADER.size:
+            raise ValueError('Delta telemetry bundle too short: %d bytes' % len(package))
+
+        code, size, sequence, timestamp = TelemetryBundle.HEADER.unpack_from(package)
+
+        if code != CODE or len(package) < size + 4:
+            raise ValueError('Not a complete delta telemetry bundle')
+
+        if self.__sequence is not None and sequence != (self.__sequence + 1) & 0xFFFFFFFF:
+            self.lost += (sequence - self.__sequence - 1) & 0xFFFFFFFF
+            self.__values.clear()
+
+        self.__sequence = sequence
+
+        records = []
+        offset = TelemetryBundle.HEADER.size
+        end = size + 4
+
+        while offset < end:
+
+            header, offset = read_varint(package, offset, end)
+            count, offset = read_varint(package, offset, end)
+            record_code = header >> 1
+
+            if not header & 1:
+                values = []
+                for _ in range(count):
+                    value, offset = read_varint(package, offset, end)
+                    values.append(unzigzag(value))
+
+            else:
+                if offset + (count + 7) // 8 > end:
+                    raise ValueError('Truncated delta telemetry bundle record')
+
+                bitmap = package[offset:offset + (count + 7) // 8]
+                offset += len(bitmap)
+                deltas = {}
+                for i in range(count):
+                    if bitmap[i >> 3] & 1 << (i & 7):
+                        deltas[i], offset = read_varint(package, offset, end)
+
+                reference = self.__values.get(record_code)
+
+                # Values lost with a package, the getter is skipped until its next keyframe
+                if reference is None or len(reference) != count:
+                    self.skipped += 1
+                    continue
+
+                values = list(reference)
+                for i, delta in deltas.items():
+                    values[i] += unzigzag(delta)
+
+            self.__values[record_code] = values
+            records.append((record_code, tuple(values)))
+
+        return sequence, timestamp, records
+
+
+def zigzag(value):
+
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def unzigzag(value):
+
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+# Largest package of the records: header, code and count of each record, its bitmap and a varint of 64 bits values
+
+def max_size(records):
+
+    return TelemetryBundle.HEADER.size + sum(6 + (len(values) + 7) // 8 + 10 * len(values) for _, values in records)
+
+
+# Writes the LEB128 varint of a non negative integer at offset, returns its end: 7 bits per byte, least significant
+# first, the high bit is set on every byte but the last one
+
+def write_varint(buffer, offset, value):
+
+    while value > 0x7F:
+        buffer[offset] = value & 0x7F | 0x80
+        value >>= 7
+        offset += 1
+
+    buffer[offset] = value
+
+    return offset + 1
+
+
+# Returns (value, next offset)
+
+def read_varint(data, offset, end):
+
+    value = 0
+    shift = 0
+
+    while True:
+
+        if offset >= end:
+            raise ValueError('Truncated varint on delta telemetry bundle')
+
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+
+        if not byte & 0x80:
+            return value, offset
+
+        shift += 7
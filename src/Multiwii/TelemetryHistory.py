@@ -0,0 +1,176 @@
+import re
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from src.Multiwii import MspMessages
+
+
+# NumPy type of each struct format character used by the registry
+NUMPY_TYPES = {'b': 'i1', 'B': 'u1', 'h': 'i2', 'H': 'u2', 'i': 'i4', 'I': 'u4', 'l': 'i4', 'L': 'u4', 'q': 'i8',
+               'Q': 'u8', 'f': 'f4', 'd': 'f8'}
+
+
+# Returns the NumPy type of each field of a MSP message, as sent on the wire, from its registry struct
+
+def field_types(message):
+
+    types = []
+
+    for count, char in re.findall(r'(\d*)([a-zA-Z?])', message.struct.format):
+        types.extend(['<' + NUMPY_TYPES[char]] * int(count or 1))
+
+    return types
+
+
+# Returns the structured dtype of the history of a MSP message, derived from its registry struct: one column per field
+# (float64 for the scaled ones) plus the elapsed and timestamp columns of the snapshots. Only fixed size messages have
+# a history, None is returned for the others.
+
+def history_dtype(message):
+
+    if isinstance(message, (MspMessages.MspArrayMessage, MspMessages.MspNamesMessage)) or not message.fields:
+        return None
+
+    types = field_types(message)
+    fields = [(field, 'f8' if field in message.scale else types[i]) for i, field in enumerate(message.fields)]
+
+    return numpy.dtype(fields + [('elapsed', 'i8'), ('timestamp', 'i8')])
+
+
+# History of a MSP message: a preallocated structured array used as a ring buffer, so appending a snapshot writes a
+# row in place and never grows. Rows are returned oldest first; times are monotonic nanoseconds, as the snapshot
+# timestamps.
+
+class MessageHistory(object):
+
+    def __init__(self, message, capacity):
+
+        self.message = message
+        self.capacity = capacity
+        self.dtype = history_dtype(message)
+        self.fields = list(message.fields)
+        self.buffer = numpy.zeros(capacity, dtype=self.dtype)
+        self.count = 0
+
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+
+        return min(self.count, self.capacity)
+
+    def append(self, snapshot):
+
+        with self.__lock:
+            self.buffer[self.__next] = snapshot
+            self.__next = (self.__next + 1) % self.capacity
+            self.count += 1
+
+    def clear(self):
+
+        with self.__lock:
+            self.__next = 0
+            self.count = 0
+
+    # Last n rows (every row if n is None)
+
+    def latest(self, n=None):
+
+        with self.__lock:
+
+            size = len(self)
+            n = size if n is None else max(0, min(n, size))
+            start = self.__next - n
+
+            if start >= 0:
+                return self.buffer[start:self.__next].copy()
+
+            return numpy.concatenate((self.buffer[start:], self.buffer[:self.__next]))
+
+    # Rows received between t0 and t1 (included), as monotonic nanoseconds. None leaves that end open.
+
+    def window(self, t0=None, t1=None):
+
+        with self.__lock:
+
+            if self.count >= self.capacity:
+                # Both segments are sorted by timestamp, the old one goes first
+                segments = (self.buffer[self.__next:], self.buffer[:self.__next])
+            else:
+                segments = (self.buffer[:self.__next],)
+
+            return numpy.concatenate([self.__slice(segment, t0, t1) for segment in segments])
+
+    # Rows received in the last seconds
+
+    def recent(self, seconds):
+
+        return self.window(time.monotonic_ns() - int(seconds * 1000000000))
+
+    # Count, mean, min, max and variance of each field (or of the given ones) between t0 and t1
+
+    def stats(self, t0=None, t1=None, fields=None):
+
+        rows = self.window(t0, t1)
+        stats = {}
+
+        for field in fields or self.fields:
+
+            if len(rows):
+                column = rows[field].astype(numpy.float64)
+                stats[field] = {'count': len(rows), 'mean': float(column.mean()), 'min': float(column.min()),
+                                'max': float(column.max()), 'var': float(column.var())}
+            else:
+                stats[field] = {'count': 0, 'mean': 0.0, 'min': 0.0, 'max': 0.0, 'var': 0.0}
+
+        return stats
+
+    @staticmethod
+    def __slice(segment, t0, t1):
+
+        timestamps = segment['timestamp']
+        start = 0 if t0 is None else numpy.searchsorted(timestamps, t0, 'left')
+        end = len(segment) if t1 is None else numpy.searchsorted(timestamps, t1, 'right')
+
+        return segment[start:end]
+
+
+# Histories of the getters with a fixed size payload, keyed by MSP code. Set it as the history of the Drone to record
+# every published snapshot. Capacity is the number of rows kept per message: either a number for all of them or a dict
+# by code (messages without an entry are not recorded).
+
+class TelemetryHistory(object):
+
+    def __init__(self, capacity=3000):
+
+        if numpy is None:
+            raise ImportError("The telemetry history needs numpy: pip install MultiWiiServer[history]")
+
+        self.histories = {}
+
+        for message in MspMessages.GETTERS:
+
+            size = capacity.get(message.code, 0) if isinstance(capacity, dict) else capacity
+
+            if size > 0 and history_dtype(message) is not None:
+                self.histories[message.code] = MessageHistory(message, size)
+
+    def __getitem__(self, code):
+
+        return self.histories[code]
+
+    def __contains__(self, code):
+
+        return code in self.histories
+
+    def append(self, message, snapshot):
+
+        history = self.histories.get(message.code)
+
+        if history is not None:
+            history.append(snapshot)
@@ -0,0 +1,87 @@
+import heapq
+import threading
+import time
+
+
+# Schedules the telemetry polls with a rate per MSP message (e.g. ATTITUDE at 50 Hz, ALTITUDE at 5 Hz). Keeps a heap
+# of (due time, command) on the monotonic clock, and sleeps until the next deadline instead of busy waiting. When the
+# link can not keep up, the missed polls are not queued up: they are counted as overruns and the message is scheduled
+# on its next slot.
+
+class TelemetryScheduler(object):
+
+    def __init__(self, rates):
+
+        self.rates = dict(rates)
+        self.overruns = dict.fromkeys(self.rates, 0)
+        self.running = True
+
+        self.__periods = dict((cmd, 1.0 / rate) for cmd, rate in self.rates.items() if rate > 0)
+        self.__wakeup = threading.Event()
+
+        now = time.monotonic()
+        self.__heap = [(now, cmd) for cmd in self.__periods]
+        heapq.heapify(self.__heap)
+
+    # Seconds until the next poll is due, None if there is nothing to poll
+
+    def delay(self, now=None):
+
+        if not self.__heap:
+            return None
+
+        now = time.monotonic() if now is None else now
+
+        return max(0.0, self.__heap[0][0] - now)
+
+    # Returns the commands that are due and schedules their next poll
+
+    def pop_due(self, now=None):
+
+        now = time.monotonic() if now is None else now
+        cmds = []
+
+        while self.__heap and self.__heap[0][0] <= now:
+
+            due, cmd = heapq.heappop(self.__heap)
+            cmds.append(cmd)
+
+            period = self.__periods[cmd]
+            next_due = due + period
+
+            if next_due <= now:
+                missed = int((now - next_due) / period) + 1
+                self.overruns[cmd] += missed
+                next_due += missed * period
+
+            heapq.heappush(self.__heap, (next_due, cmd))
+
+        return cmds
+
+    # Sleeps until the next poll is due and returns the due commands, or an empty list once stopped
+
+    def wait(self):
+
+        while self.running:
+
+            delay = self.delay()
+
+            if delay is None:
+                self.__wakeup.wait()
+                continue
+
+            if delay > 0 and self.__wakeup.wait(delay):
+                continue
+
+            return self.pop_due()
+
+        return []
+
+    def stop(self):
+
+        self.running = False
+        self.__wakeup.set()
+
+    def total_overruns(self):
+
+        return sum(self.overruns.values())
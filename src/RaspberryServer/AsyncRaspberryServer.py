@@ -0,0 +1,188 @@
+import asyncio
+import time
+
+from src.Multiwii import Logger, TelemetryBundle, TelemetryDelta
+from src.Multiwii.AsyncMultiwii import AsyncMultiWii
+from src.RaspberryServer.RaspberryServer import RaspberryServer
+
+log = Logger.get_logger('AsyncRaspberryServer')
+rc_log = Logger.RateLimitedLogger(log)
+
+
+class RaspberryServerProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        log.warning('Socket err: %s', exc)
+
+
+# asyncio mode of the RaspberryServer, uses the same Android APP / Raspberry protocol. Control, telemetry and the
+# serial port (AsyncMultiWii) share a single event loop instead of one thread per activity.
+#
+# Telemetry is streamed to a single device: the TelemetryHub polls with the blocking MultiWii and is not used here, so
+# SUBSCRIBE and UNSUBSCRIBE are not supported and a START_TELEMETRY received while a stream is active is ignored. As
+# on the threaded server, any device can ask for one-shot getters and stats, and only the active one controls the drone.
+
+class AsyncRaspberryServer(RaspberryServer):
+
+    # The attributes of the RaspberryServer are kept, its socket and dispatcher thread are not used: every package is
+    # handled on the event loop as it is received, nothing is queued.
+
+    def __init__(self, ip_address, port):
+        RaspberryServer.__init__(self, ip_address, port, AsyncMultiWii())
+        self.transport = None
+
+        self.__telemetry_task = None
+        self.__last_package = 0
+        self.__finished = None
+
+    # Connects to the MultiWii, binds the socket and serves until an END_CONNECTION package is received
+
+    async def serve(self):
+
+        loop = asyncio.get_running_loop()
+        self.__finished = loop.create_future()
+
+        await self.mw.connect()
+
+        log.info('Starting server ...')
+        await loop.create_datagram_endpoint(lambda: RaspberryServerProtocol(self), local_addr=self.address)
+        self.server_started = True
+        self.__last_package = time.time()
+        log.info('Server started!')
+
+        watchdog = asyncio.ensure_future(self.__watchdog())
+
+        try:
+            await self.__finished
+        finally:
+            watchdog.cancel()
+            self.__stop_telemetry()
+            self.transport.close()
+            self.mw.close()
+
+    def start_listening(self):
+
+        asyncio.run(self.serve())
+
+    def datagram_received(self, p, address):
+
+        self.datagrams_received += 1
+
+        try:
+            code, data = TelemetryBundle.unpack_package(p, len(p))
+        except ValueError as err:
+            log.warning('Malformed package dropped: %s', err)
+            return
+
+        if address == self.active_device or self.active_device == "" or code // 100 == 1 or code == self.GET_STATS:
+
+            self.__last_package = time.time()
+            self.evaluate_package(code, data, address)
+
+    def send_package(self, package, address):
+
+        self.transport.sendto(package, address)
+        self.datagrams_sent += 1
+
+    def server_config_package(self, code, address):
+
+        if code == self.START_CONNECTION:
+            self.send_package(self.create_package(self.ACCEPT_CONNECTION, 2, [0]), address)
+            self.active_device = address
+            log.info('Start connection package sent!')
+
+        if code == self.GET_STATS:
+            self.send_package(self.stats_package(), address)
+
+        if code == self.END_CONNECTION:
+            self.server_started = False
+            if not self.__finished.done():
+                self.__finished.set_result(None)
+            log.info('Connection finished!')
+
+    def drone_control_packages(self, code, data):
+
+        if code == self.ARM:
+            asyncio.ensure_future(self.mw.arm())
+            log.info('Received ARM command')
+
+        if code == self.DISARM:
+            asyncio.ensure_future(self.mw.disarm())
+            log.info('Received DISARM command')
+
+        if code == self.SET_RC:
+            self.set_rc_received += 1
+            try:
+                self.mw.set_rc(list(data))
+            except ValueError as err:
+                rc_log.warning('SET_RC package dropped: %s', err)
+
+    def drone_telemetry_package(self, code, data, address):
+
+        if code == self.START_TELEMETRY:
+            log.info('Telemetry command received')
+            if not self.telemetry_activated:
+                options = data[0] & self.TELEMETRY_OPTIONS if data else 0
+                self.send_package(self.create_package(self.ACCEPT_TELEMETRY, 1, [options]), address)
+                self.__telemetry_task = asyncio.ensure_future(self.__telemetry(address, options))
+                self.telemetry_activated = True
+                log.info('Telemetry task started!')
+
+        if code == self.END_TELEMETRY:
+            self.__stop_telemetry()
+            log.info('Stop telemetry command received!')
+
+        if code in self.TELEMETRY_FIELDS:
+            asyncio.ensure_future(self.__send_telemetry(code, address))
+
+    async def __send_telemetry(self, code, address):
+
+        self.send_values(code, await self.mw.get_message(code), address)
+
+    async def __telemetry(self, address, options):
+
+        sequence = 0
+        encoder = TelemetryDelta.DeltaEncoder(self.keyframe_interval)
+
+        async for updates in self.mw.telemetry_stream():
+
+            if options & self.DELTA:
+                if updates:
+                    self.send_delta(list(updates.items()), sequence, encoder, address)
+                    sequence += 1
+            elif options & self.BUNDLE:
+                if updates:
+                    self.send_bundle(list(updates.items()), sequence, address)
+                    sequence += 1
+            else:
+                for code, values in updates.items():
+                    self.send_values(code, values, address)
+
+    def __stop_telemetry(self):
+
+        if self.__telemetry_task is not None:
+            self.__telemetry_task.cancel()
+            self.__telemetry_task = None
+
+        self.telemetry_activated = False
+
+    # Forgets the active device after server_timeout seconds without packages, as the threaded server does
+
+    async def __watchdog(self):
+
+        while True:
+            await asyncio.sleep(self.server_timeout)
+
+            if self.active_device != "" and time.time() - self.__last_package >= self.server_timeout:
+                log.warning('Socket err: timed out')
+                self.active_device = ""
+                log.info('Restarting server...')
@@ -1,9 +1,17 @@
+import queue
 import struct
 import socket
+import threading
+import time
 
-import _thread
-
+from src.Multiwii import Logger, LatencyHistogram, MspMessages, TelemetryBundle, TelemetryDelta
 from src.Multiwii.Multiwii import MultiWii
+from src.RaspberryServer import TelemetryHub
+
+log = Logger.get_logger('RaspberryServer')
+# Per datagram messages, at most one per second
+packet_log = Logger.RateLimitedLogger(log)
+rc_log = Logger.RateLimitedLogger(log)
 
 
 class RaspberryServer:
@@ -13,92 +21,307 @@ class RaspberryServer:
     START_CONNECTION = 300
     ACCEPT_CONNECTION = 301
     END_CONNECTION = 302
+    GET_STATS = 303
+    STATS = 304
     ARM = 220
     DISARM = 221
     START_TELEMETRY = 120
     ACCEPT_TELEMETRY = 121
     END_TELEMETRY = 122
+    SUBSCRIBE = 123
+    UNSUBSCRIBE = 124
+    TELEMETRY_BUNDLE = TelemetryBundle.CODE
+    TELEMETRY_DELTA = TelemetryDelta.CODE
     RAW_IMU = 102
     SERVO = 103
     MOTOR = 104
     RC = 105
     ATTITUDE = 108
     ALTITUDE = 109
+    PID = 112
     SET_RC = 200
 
-    def __init__(self, ip_address, port):
+    # Values sent on each telemetry package, by MSP getter, in the units of the flight controller (attitude angles in
+    # tenths of degree)
+    TELEMETRY_FIELDS = MultiWii.UDP_FIELDS
+
+    # Telemetry options, requested as a bit mask on the START_TELEMETRY data and answered with the accepted ones on the
+    # ACCEPT_TELEMETRY data. BUNDLE sends all the samples of a tick on a single TELEMETRY_BUNDLE package. DELTA sends
+    # them on a single TELEMETRY_DELTA package instead, delta encoded against the previous ones (see TelemetryDelta).
+    BUNDLE = 0x01
+    DELTA = 0x02
+    TELEMETRY_OPTIONS = BUNDLE | DELTA
+
+    # Packages that wait for the flight controller (arm/disarm sequences, one-shot getters). They are handled by the
+    # dispatcher thread, so the listener keeps receiving SET_RC and the other packages meanwhile. Every telemetry getter
+    # is queued, the ones answered from a recent sample too.
+    QUEUED = (ARM, DISARM) + tuple(TELEMETRY_FIELDS)
+    # Queued packages waiting for the dispatcher thread, the next ones are dropped while it is full
+    QUEUE_SIZE = 64
+    # Largest package received, the rest of a longer datagram is discarded
+    RECEIVE_SIZE = 256
+
+    # Counters sent on a STATS package, in order. Each one is a big endian unsigned 32 bits value that wraps around.
+    # New counters are appended, so clients that read the first ones keep working.
+    STATS_FIELDS = ['datagrams_received', 'datagrams_sent', 'set_rc_received', 'rc_written', 'serial_bytes_in',
+                    'serial_bytes_out', 'frames', 'checksum_errors', 'error_frames', 'resync_bytes', 'telemetry_ticks',
+                    'telemetry_overruns', 'stale_skipped', 'serial_queue', 'serial_in_flight', 'recorder_dropped',
+                    'requests_dropped', 'dispatch_queue', 'subscribers']
+
+    def __init__(self, ip_address, port, mw=None):
         self.ip_address = ip_address
         self.port = port
         self.address = (self.ip_address, self.port)
-        self.mw = MultiWii()
+        self.mw = mw or MultiWii()
         self.sock = ""
         self.server_started = False
         self.telemetry_activated = False
         self.active_device = ""
         self.server_timeout = 5.0
+        self.datagrams_received = 0
+        self.datagrams_sent = 0
+        self.set_rc_received = 0
+        self.requests_dropped = 0
+        # Time from the reception of each package to its handling, by code, see dispatch_stats
+        self.dispatch_latency = {}
+        # Telemetry subscriptions of the clients, started with the first one
+        self.hub = None
+        self.subscription_timeout = 30.0
+        # One-shot getters are answered with the last sample polled if it is not older than this (seconds)
+        self.sample_max_age = 0.1
+        # Records of a getter between two keyframes on the DELTA telemetry
+        self.keyframe_interval = TelemetryDelta.KEYFRAME_INTERVAL
+
+        self.__requests = queue.Queue(RaspberryServer.QUEUE_SIZE)
+        self.__dispatcher = None
 
     def start_server(self):
 
         if not self.server_started:
 
             try:
-                print("Starting server ...")
+                log.info('Starting server ...')
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                print("Socket creation: Socket created!")
+                log.info('Socket creation: Socket created!')
                 self.sock.bind(self.address)
                 self.sock.settimeout(self.server_timeout)
-                print("Socket binding: Socket bound!")
+                log.info('Socket binding: Socket bound!')
                 self.server_started = True
-                print("Server started!")
+                log.info('Server started!')
 
             except socket.error as err:
-                print("Error starting server: {}".format(err))
+                log.error('Error starting server: %s', err)
+
+    # Receives packages until an END_CONNECTION package is received. The QUEUED ones are handed to the dispatcher thread
+    # and the others are handled as they are received. After server_timeout seconds without packages the active device
+    # is forgotten, so another one can connect.
 
     def start_listening(self):
 
         if self.server_started:
-            print("Start listening, waiting for data")
+            log.info('Start listening, waiting for data')
+            self.__start_dispatcher()
+            # Every package is received on this buffer, only the unpacked values are kept
+            buffer = bytearray(self.RECEIVE_SIZE)
 
             while self.server_started:
 
                 try:
 
-                    package = self.sock.recvfrom(40)
-                    p = package[0]
-                    address = package[1]
+                    length, address = self.sock.recvfrom_into(buffer)
+                    received = time.perf_counter_ns()
+                    self.datagrams_received += 1
 
-                    if address == self.active_device or self.active_device == "":
+                    # '>' for BigEndian encoding, see TelemetryBundle.unpack_package
+                    code, data = TelemetryBundle.unpack_package(buffer, length)
 
-                        print("Received {} bytes from {}".format(len(package), address))
+                    if self.hub is not None:
+                        self.hub.touch(address)
 
-                        # '>' for BigEndian encoding , change to < for LittleEndian, or @ for native.
+                    # Only the active device controls the drone, any device can ask for telemetry and stats
+                    if address == self.active_device or self.active_device == "" or code // 100 == 1 or \
+                            code == self.GET_STATS:
 
-                        code = struct.unpack('>h', p[:2])[0]
-                        size = struct.unpack('>h', p[2:4])[0]
-                        data = struct.unpack('>' + 'h' * int(size / 2), p[4:size + 4])
-
-                        print("Code: {0} Size: {1} Data: {2} Address: {3}".format(code, size, data, address))
+                        packet_log.debug('Received code: %d data: %s address: %s', code, data, address)
 
                         # Determines what kind of package has received, and acts in consequence
-                        self.evaluate_package(code, data, address)
+                        if code in self.QUEUED:
+                            self.__queue(code, data, address, received)
+                        else:
+                            self.__dispatch(code, data, address, received)
+
+                except ValueError as err:
+                    packet_log.warning('Malformed package dropped: %s', err)
 
                 except socket.timeout as err:
-                    print("Socket err: ", err)
+                    log.warning('Socket err: %s', err)
                     self.active_device = ""
-                    print("Restarting server...")
-                    self.start_listening()
+                    log.info('Restarting server...')
+
+            self.__stop_dispatcher()
+
+            if self.hub is not None:
+                self.hub.stop()
+                self.hub = None
+            self.telemetry_activated = False
+
+    def __start_dispatcher(self):
+
+        if self.__dispatcher is None:
+            self.__dispatcher = threading.Thread(target=self.__dispatch_loop, name='RaspberryServer', daemon=True)
+            self.__dispatcher.start()
+
+    # The packages still queued are dropped, the connection has finished
+
+    def __stop_dispatcher(self):
+
+        if self.__dispatcher is not None:
+
+            try:
+                while True:
+                    self.__requests.get_nowait()
+            except queue.Empty:
+                pass
+
+            self.__requests.put(None)
+            self.__dispatcher.join()
+            self.__dispatcher = None
+
+    def __queue(self, code, data, address, received):
+
+        try:
+            self.__requests.put_nowait((code, data, address, received))
+
+        except queue.Full:
+            self.requests_dropped += 1
+            packet_log.warning('Dispatcher busy, package dropped: %d', code)
+
+    def __dispatch_loop(self):
+
+        while True:
+
+            request = self.__requests.get()
+
+            if request is None:
+                return
+
+            try:
+                self.__dispatch(*request)
+
+            except Exception:
+                log.exception('Error handling package: %d', request[0])
+
+    def __dispatch(self, code, data, address, received):
+
+        histogram = self.dispatch_latency.get(code)
+
+        if histogram is None:
+            histogram = self.dispatch_latency[code] = LatencyHistogram.LatencyHistogram()
+
+        histogram.record(time.perf_counter_ns() - received)
+        self.evaluate_package(code, data, address)
+
+    # Percentiles of the time from the reception of each package to its handling, by code, in milliseconds:
+    # {code: {'count', 'mean', 'p50', 'p90', 'p99', 'max'}}
+
+    def dispatch_stats(self):
+
+        return dict((code, histogram.stats()) for code, histogram in list(self.dispatch_latency.items()))
+
+    # Packs a package on the package buffer of the thread and returns a memoryview of it, valid until the next package
+    # of the thread: it must be sent before (see TelemetryBundle.package_buffer)
 
     @staticmethod
-    def __create_package(code, size, data):
-        # '>' for BigEndian encoding , change to < for LittleEndian, or @ for native.
-        code = struct.pack('>h', code)
-        size = struct.pack('>h', size)
-        data = struct.pack('>' + 'h' * len(data), *data)
-        package = code + size + data
+    def create_package(code, size, data):
+        # '>' for BigEndian encoding, see TelemetryBundle.pack_package
+        buffer = TelemetryBundle.package_buffer(4 + 2 * len(data))
+        end = TelemetryBundle.pack_package(buffer, 0, code, data, size)
+
+        return memoryview(buffer)[:end]
+
+    def send_package(self, package, address):
+
+        self.sock.sendto(package, address)
+        self.datagrams_sent += 1
 
-        print("Package created -> " + str(package))
+    # Sends a telemetry package with the TELEMETRY_FIELDS of a Drone snapshot
 
-        return package
+    def send_values(self, code, values, address):
+
+        data = MspMessages.get(code).raw_values(values, self.TELEMETRY_FIELDS[code])
+
+        self.send_package(self.create_package(code, 2 * len(data), data), address)
+
+    # Sends the samples of a tick, [(code, snapshot), ...], on a single TELEMETRY_BUNDLE package. The timestamp of the
+    # bundle is the reception time of the newest sample.
+
+    def send_bundle(self, samples, sequence, address):
+
+        records, timestamp = self.__records(samples)
+        buffer = TelemetryBundle.package_buffer(TelemetryBundle.bundle_size(records))
+        end = TelemetryBundle.pack_bundle(buffer, sequence, timestamp, records)
+
+        self.send_package(memoryview(buffer)[:end], address)
+
+    # Sends the samples of a tick on a single TELEMETRY_DELTA package, encoded by the DeltaEncoder of the client
+
+    def send_delta(self, samples, sequence, encoder, address):
+
+        records, timestamp = self.__records(samples)
+
+        self.send_package(encoder.encode(sequence, timestamp, records), address)
+
+    # Sends the samples due to a subscriber as its telemetry options say
+
+    def send_samples(self, address, samples, subscription):
+
+        if subscription.options & self.DELTA:
+            if subscription.encoder is None:
+                subscription.encoder = TelemetryDelta.DeltaEncoder(self.keyframe_interval)
+            self.send_delta(samples, subscription.sequence, subscription.encoder, address)
+            subscription.sequence += 1
+        elif subscription.options & self.BUNDLE:
+            self.send_bundle(samples, subscription.sequence, address)
+            subscription.sequence += 1
+        else:
+            for code, values in samples:
+                self.send_values(code, values, address)
+
+    # TELEMETRY_FIELDS values of each sample and the reception time of the newest one, in milliseconds
+
+    def __records(self, samples):
+
+        records = [(code, MspMessages.get(code).raw_values(values, self.TELEMETRY_FIELDS[code]))
+                   for code, values in samples]
+
+        return records, max(values.timestamp for _, values in samples) // 1000000
+
+    # Counters of the server and of the MultiWii, by name
+
+    def stats(self):
+
+        stats = self.mw.stats()
+        stats['datagrams_received'] = self.datagrams_received
+        stats['datagrams_sent'] = self.datagrams_sent + stats['datagrams_sent']
+        stats['set_rc_received'] = self.set_rc_received
+        stats['requests_dropped'] = self.requests_dropped
+        stats['dispatch_queue'] = self.__requests.qsize()
+        stats['subscribers'] = self.hub.subscribers() if self.hub is not None else 0
+
+        if self.hub is not None:
+            stats['telemetry_ticks'] += self.hub.ticks
+            stats['telemetry_overruns'] += self.hub.total_overruns()
+
+        return stats
+
+    # STATS package: code, size and the STATS_FIELDS counters
+
+    def stats_package(self):
+
+        stats = self.stats()
+        data = [stats.get(field, 0) & 0xFFFFFFFF for field in self.STATS_FIELDS]
+
+        return struct.pack('>2h%dI' % len(data), self.STATS, 4 * len(data), *data)
 
     def evaluate_package(self, code, data, address):
 
@@ -109,22 +332,24 @@ class RaspberryServer:
             self.drone_control_packages(code, data)
 
         if int(str(code)[:1]) == 1:
-            self.drone_telemetry_package(code, address)
+            self.drone_telemetry_package(code, data, address)
 
     # covers the basic packages for communication and server configuration
 
     def server_config_package(self, code, address):
 
         if code == self.START_CONNECTION:
-            self.sock.sendto(self.__create_package(self.ACCEPT_CONNECTION, 2, [0]),
-                             address)
+            self.send_package(self.create_package(self.ACCEPT_CONNECTION, 2, [0]), address)
             self.active_device = address
-            print("Start connection package sent!")
+            log.info('Start connection package sent!')
+
+        if code == self.GET_STATS:
+            self.send_package(self.stats_package(), address)
 
         if code == self.END_CONNECTION:
             self.sock.close()
             self.server_started = False
-            print("Connection finished!")
+            log.info('Connection finished!')
 
     # covers the packages used to control the drone (arm, disarm, rc, ...)
 
@@ -132,59 +357,80 @@ class RaspberryServer:
 
         if code == self.ARM:
             self.mw.arm()
-            print("Received ARM command")
+            log.info('Received ARM command')
 
         if code == self.DISARM:
             self.mw.disarm()
-            print("Received DISARM command")
+            log.info('Received DISARM command')
 
         if code == self.SET_RC:
-            self.mw.set_rc(list(data))
-            print("Received SET_RC command, values: " + str(data))
+            self.set_rc_received += 1
+            rc_log.debug('Received SET_RC command, values: %s', data)
+            # Values are received as signed words, a negative channel is dropped
+            try:
+                self.mw.set_rc(list(data))
+            except ValueError as err:
+                rc_log.warning('SET_RC package dropped: %s', err)
 
-    # covers the packages used to receive information about the drone state (altitude, acc, gyro, ...)
+    # covers the packages used to receive information about the drone state (altitude, acc, gyro, ...).
+    # START_TELEMETRY subscribes the device to the getters enabled on the settings file at their rates, with the
+    # TELEMETRY_OPTIONS given on its data, until END_TELEMETRY or END_CONNECTION. SUBSCRIBE subscribes to the given
+    # (code, Hz) pairs and UNSUBSCRIBE removes the given codes (all of them if none). A SUBSCRIBE subscription expires
+    # after subscription_timeout seconds without packages from the device: any package renews it, so a device that
+    # only listens sends one (e.g. GET_STATS) as keepalive. Several devices can be subscribed at the same time, see
+    # TelemetryHub. One-shot getters are answered to the device that asks for them.
 
-    def drone_telemetry_package(self, code, address):
+    def drone_telemetry_package(self, code, data, address):
 
         if code == self.START_TELEMETRY:
-            print("Telemetry command received")
-            if not self.telemetry_activated:
-                self.sock.sendto(self.__create_package(self.ACCEPT_TELEMETRY, 1, [0]),
-                                 address)
-                print("Telemetry accept message sent")
-                # creates a new thread to manage the telemetry loop
-                _thread.start_new_thread(self.mw.udp_telemetry_loop, (address, self.sock))
+            log.info('Telemetry command received')
+            options = data[0] & self.TELEMETRY_OPTIONS if data else 0
+            self.__subscribe(address, self.mw.telemetry_rates(), options, persistent=True)
+            log.info('Telemetry accept message sent')
 
-                self.telemetry_activated = True
+        if code == self.SUBSCRIBE:
+            self.__subscribe(address, dict(zip(data[::2], data[1::2])))
 
-                print("Telemetry thread started!")
+        if code == self.UNSUBSCRIBE and self.hub is not None:
+            self.hub.unsubscribe(address, data)
 
         if code == self.END_TELEMETRY:
-            self.mw.stop_udp_telemetry()
-            self.telemetry_activated = False
-            print("Stop telemetry command received!")
+            if self.hub is not None:
+                self.hub.unsubscribe(address)
+            log.info('Stop telemetry command received!')
+
+        if code in self.TELEMETRY_FIELDS:
+            values = self.__latest(code)
+            self.send_values(code, values, address)
+            packet_log.debug('Received get command: %d, values: %s', code, values)
+
+    def __subscribe(self, address, rates, options=None, persistent=False):
+
+        if self.hub is None:
+            self.hub = TelemetryHub.TelemetryHub(self.mw, self.send_samples, self.subscription_timeout,
+                                                 self.__telemetry_idle)
+            self.hub.start()
 
-        if code == self.ALTITUDE:
-            self.mw.udp_get_altitude()
-            print("Received get_altitude command!, values: " + str(self.mw.drone.altitude))
+        rates = dict((cmd, rate) for cmd, rate in rates.items() if cmd in self.TELEMETRY_FIELDS)
+        options = self.hub.subscribe(address, rates, options, persistent)
+        self.telemetry_activated = self.hub.subscribers() > 0
+        self.send_package(self.create_package(self.ACCEPT_TELEMETRY, 1, [options]), address)
+
+    # Called by the hub when its last subscription is removed (unsubscribed or expired)
+
+    def __telemetry_idle(self):
+
+        self.telemetry_activated = False
 
-        if code == self.ATTITUDE:
-            self.mw.udp_get_attitude()
-            print("Received get_attitude command!, values: " + str(self.mw.drone.attitude))
+    # Last sample of a getter, polled again if it is older than sample_max_age
 
-        if code == self.RAW_IMU:
-            self.mw.udp_get_raw_imu()
-            print("Received get_raw_imu command!, values: " + str(self.mw.drone.raw_imu))
+    def __latest(self, code):
 
-        if code == self.RC:
-            self.mw.udp_get_rc()
-            print("Received get_rc command!, values: " + str(self.mw.drone.rc_channels))
+        message = MspMessages.get(code)
+        values = getattr(self.mw.drone, message.attribute)
 
-        if code == self.SERVO:
-            self.mw.get_servo()
-            print("Received get_servo command!, values: " + str(self.mw.drone.servo))
+        if time.monotonic_ns() - values.timestamp > self.sample_max_age * 1000000000:
+            values = getattr(self.mw, 'get_' + message.name)()
 
-        if code == self.MOTOR:
-            self.mw.get_motor()
-            print("Received get_motor command!, values: " + str(self.mw.drone.motor))
+        return values
 
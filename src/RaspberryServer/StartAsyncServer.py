@@ -0,0 +1,11 @@
+from src.Multiwii import Logger
+from src.RaspberryServer.AsyncRaspberryServer import AsyncRaspberryServer
+
+Logger.setup()
+
+IpAddress = "192.168.0.164"
+port = 4445
+
+server = AsyncRaspberryServer(IpAddress, port)
+
+server.start_listening()
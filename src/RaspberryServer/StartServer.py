@@ -1,5 +1,8 @@
+from src.Multiwii import Logger
 from src.RaspberryServer.RaspberryServer import RaspberryServer
 
+Logger.setup()
+
 IpAddress = "192.168.0.164"
 port = 4445
 
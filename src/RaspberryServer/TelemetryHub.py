@@ -0,0 +1,261 @@
+import threading
+import time
+
+from src.Multiwii import Logger, MspMessages, SerialWorker, TelemetryScheduler
+
+log = Logger.get_logger('TelemetryHub')
+poll_log = Logger.RateLimitedLogger(log)
+
+
+# A subscription of a client: rate (Hz) by MSP getter, the next time each one is due, when it expires (None if it does
+# not), the telemetry options negotiated by the client, the sequence number of its next package and its delta encoder,
+# if any
+class Subscription(object):
+
+    def __init__(self, rates, expires, options=0):
+
+        self.rates = rates
+        self.due = dict.fromkeys(rates, 0.0)
+        self.expires = expires
+        self.options = options
+        self.sequence = 0
+        self.encoder = None
+
+
+# Shares the telemetry of the flight controller between several clients (pilot tablet, logger laptop, video
+# overlay, ...). Each client subscribes to the getters it wants at its own rate. A single poller reads each getter at
+# the highest rate subscribed, and every sample is sent from the Drone snapshot to the clients it is due to, so the
+# serial load depends on the sensor mix and not on the number of clients.
+#
+# Send is called on each tick with (address, [(code, snapshot), ...], subscription) for each client with due samples.
+# Subscriptions expire after timeout seconds without being renewed (subscribe or touch), as UDP clients may disappear
+# without unsubscribing. Persistent ones do not expire, they are kept until they are unsubscribed. Idle is called
+# without arguments when the last subscription is removed.
+
+class TelemetryHub(object):
+
+    def __init__(self, mw, send, timeout=30.0, idle=None):
+
+        self.mw = mw
+        self.send = send
+        self.timeout = timeout
+        self.idle = idle
+        self.running = False
+        self.ticks = 0
+        self.samples_sent = 0
+
+        self.__subscriptions = {}
+        self.__lock = threading.Lock()
+        self.__scheduler = None
+        self.__overruns = 0
+        self.__thread = None
+
+    def start(self):
+
+        if not self.running:
+            self.running = True
+            self.__thread = threading.Thread(target=self.__loop, name='TelemetryHub', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+
+        self.running = False
+
+        with self.__lock:
+            self.__subscriptions.clear()
+            self.__reschedule()
+
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    # Subscribes a client to the given getters, {cmd: Hz}. Rates are added to the ones it already has, a rate of 0
+    # removes the getter. Options replaces the telemetry options of the client, when given. A persistent subscription
+    # stays persistent when it is changed. Returns its options.
+
+    def subscribe(self, address, rates, options=None, persistent=False):
+
+        with self.__lock:
+
+            subscription = self.__subscriptions.get(address)
+            rates = dict((cmd, rate) for cmd, rate in rates.items() if MspMessages.get(cmd) in MspMessages.GETTERS)
+
+            if subscription is None:
+                subscription = self.__subscriptions[address] = Subscription({}, 0.0)
+
+            for cmd, rate in rates.items():
+                if rate > 0:
+                    subscription.rates[cmd] = rate
+                    subscription.due[cmd] = 0.0
+                else:
+                    subscription.rates.pop(cmd, None)
+                    subscription.due.pop(cmd, None)
+
+            if persistent:
+                subscription.expires = None
+            elif subscription.expires is not None:
+                subscription.expires = time.monotonic() + self.timeout
+
+            # New options start a new stream: the client gets keyframes again
+            if options is not None:
+                subscription.options = options
+                subscription.encoder = None
+            options = subscription.options
+
+            if not subscription.rates:
+                del self.__subscriptions[address]
+
+            self.__reschedule()
+            emptied = not self.__subscriptions
+
+        log.info('Subscription of %s: %s', address, rates)
+
+        if emptied:
+            self.__idle()
+
+        return options
+
+    # Unsubscribes a client from the given getters, or from all of them
+
+    def unsubscribe(self, address, cmds=None):
+
+        if cmds:
+            self.subscribe(address, dict.fromkeys(cmds, 0))
+            return
+
+        with self.__lock:
+            if self.__subscriptions.pop(address, None) is not None:
+                self.__reschedule()
+            emptied = not self.__subscriptions
+
+        log.info('Subscription of %s removed', address)
+
+        if emptied:
+            self.__idle()
+
+    # Renews the subscription of a client, any package received from it does
+
+    def touch(self, address):
+
+        subscription = self.__subscriptions.get(address)
+
+        if subscription is not None and subscription.expires is not None:
+            subscription.expires = time.monotonic() + self.timeout
+
+    def subscribers(self):
+
+        return len(self.__subscriptions)
+
+    # Highest rate subscribed by getter, {cmd: Hz}
+
+    def rates(self):
+
+        rates = {}
+
+        for subscription in list(self.__subscriptions.values()):
+            for cmd, rate in subscription.rates.items():
+                rates[cmd] = max(rate, rates.get(cmd, 0))
+
+        return rates
+
+    def total_overruns(self):
+
+        scheduler = self.__scheduler
+
+        return self.__overruns + (scheduler.total_overruns() if scheduler is not None else 0)
+
+    def __idle(self):
+
+        if self.idle is not None:
+            self.idle()
+
+    # The scheduler is replaced when the subscribed rates change: the current one is stopped, which wakes up the loop
+
+    def __reschedule(self):
+
+        scheduler = self.__scheduler
+        self.__scheduler = None
+
+        if scheduler is not None:
+            self.__overruns += scheduler.total_overruns()
+            scheduler.stop()
+
+    def __loop(self):
+
+        while self.running:
+
+            with self.__lock:
+                if not self.running:
+                    return
+                if self.__scheduler is None:
+                    self.__scheduler = TelemetryScheduler.TelemetryScheduler(self.rates())
+                scheduler = self.__scheduler
+
+            cmds = scheduler.wait()
+
+            if not cmds:
+                continue
+
+            # A failed tick must not end the poller, the telemetry of every subscriber depends on it
+            try:
+                self.__poll(cmds, scheduler)
+            except Exception as err:
+                poll_log.warning('Telemetry tick error: %s', err)
+
+    def __poll(self, cmds, scheduler):
+
+        replies = self.mw.get_many(cmds, SerialWorker.SerialWorker.TELEMETRY)
+        snapshots = {}
+
+        for cmd, reply in replies.items():
+            message = MspMessages.get(cmd)
+            snapshots[cmd] = getattr(self.mw, 'get_' + message.name)(reply)
+
+        for cmd in cmds:
+            if cmd not in replies:
+                poll_log.warning('No reply for telemetry getter: %d', cmd)
+
+        self.ticks += 1
+        self.__fan_out(snapshots, scheduler)
+
+    # Sends each new sample to the subscribers it is due to. A sample is due half a poll period early, so a client
+    # subscribed at the poll rate gets every sample and the slower ones get every n-th sample.
+
+    def __fan_out(self, snapshots, scheduler):
+
+        now = time.monotonic()
+        expired = []
+
+        with self.__lock:
+
+            for address, subscription in self.__subscriptions.items():
+
+                if subscription.expires is not None and subscription.expires <= now:
+                    expired.append(address)
+                    continue
+
+                samples = []
+
+                for cmd, snapshot in snapshots.items():
+
+                    due = subscription.due.get(cmd)
+
+                    if due is None or now < due - 0.5 / scheduler.rates[cmd]:
+                        continue
+
+                    period = 1.0 / subscription.rates[cmd]
+                    subscription.due[cmd] = due + period if now - due < period else now + period
+                    samples.append((cmd, snapshot))
+
+                if not samples:
+                    continue
+
+                try:
+                    self.send(address, samples, subscription)
+                    self.samples_sent += len(samples)
+                except Exception as err:
+                    poll_log.warning('Error sending telemetry to %s: %s', address, err)
+
+        for address in expired:
+            log.info('Subscription of %s expired', address)
+            self.unsubscribe(address)
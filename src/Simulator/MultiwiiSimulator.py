@@ -0,0 +1,221 @@
+import math
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+from collections import Counter
+
+from src.Multiwii import MultiwiiSettings, MspParser, MspMessages
+from src.Multiwii.Multiwii import MultiWii
+
+
+# Virtual MultiWii flight controller. Opens a pseudo-terminal and answers the MSP v1 requests received on it as the
+# firmware does, with plausible time-varying sensor data. Point the serial port of the settings file to its port (or
+# use settings()) to run the MultiWii, the server, the tests or the benchmarks without a board.
+#
+# latency is the time waited before each reply, baudrate limits the reply throughput as a real serial link would do
+# (None for unlimited) and corruption is the probability of flipping a byte of a reply. With msp_v2 it behaves as a
+# newer firmware: it answers MSP_API_VERSION, MSP_FC_VARIANT and MSP_MULTIPLE_MSP, and MSP v2 requests in MSP v2.
+
+class MultiwiiSimulator(object):
+
+    def __init__(self, latency=0.0, baudrate=115200, corruption=0.0, seed=None, msp_v2=False):
+
+        self.latency = latency
+        self.msp_v2 = msp_v2
+        # Maximum size of a MSP_MULTIPLE_MSP reply, the replies that do not fit are left out
+        self.multiple_msp_size = 255
+        self.baudrate = baudrate
+        self.corruption = corruption
+        self.random = random.Random(seed)
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.parser = MspParser.MspParser(b'<')
+        self.running = False
+        self.requests = 0
+        self.replies = 0
+        self.corrupted = 0
+        self.commands = Counter()
+
+        # Flight controller state, changed by the setters
+        self.rc = [1500, 1500, 1500, 1000, 1000, 1000, 1000, 1000]
+        self.pid = [40, 30, 23, 40, 30, 23, 85, 45, 0, 64, 25, 24, 11, 0, 0, 20, 8, 45, 14, 20, 80, 90, 10, 100, 40, 0,
+                    0, 0, 0, 0]
+        self.waypoints = {}
+
+        self.__start = time.time()
+        self.__thread = None
+
+    def start(self):
+
+        if not self.running:
+            self.running = True
+            self.__thread = threading.Thread(target=self.__loop, name='MultiwiiSimulator', daemon=True)
+            self.__thread.start()
+
+        return self
+
+    def stop(self):
+
+        self.running = False
+
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def close(self):
+
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+    # Returns a settings object whose serial port points to the simulator
+
+    def settings(self):
+
+        settings = MultiwiiSettings.Settings(self.port)
+        settings.wakeup = 0
+
+        return settings
+
+    def __loop(self):
+
+        while self.running:
+
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+
+            if not readable:
+                continue
+
+            for frame in self.parser.feed(os.read(self.master, 1024)):
+
+                # The MultiWii firmware does not know the MSP v2 frames
+                if frame.version == 2 and not self.msp_v2:
+                    continue
+
+                self.requests += 1
+                self.commands[frame.cmd] += 1
+                self.__reply(frame.cmd, frame.data, frame.version)
+
+    def __reply(self, cmd, data, version=1):
+
+        try:
+            payload = self.__handle(cmd, data)
+            frame = MspParser.create_frame(cmd, payload, b'>', version)
+
+        except (KeyError, ValueError, struct.error):
+            frame = MspParser.create_frame(cmd, b'', b'!', version)
+
+        if self.corruption and self.random.random() < self.corruption:
+            frame = bytearray(frame)
+            frame[self.random.randrange(3, len(frame))] ^= 1 << self.random.randrange(8)
+            frame = bytes(frame)
+            self.corrupted += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.baudrate:
+            # 10 bits per byte: start bit, 8 data bits and stop bit
+            time.sleep(len(frame) * 10.0 / self.baudrate)
+
+        os.write(self.master, frame)
+        self.replies += 1
+
+    # Returns the reply payload of a request. Setters store their values and are acknowledged with an empty payload,
+    # unknown commands raise KeyError and are answered with an error frame.
+
+    def __handle(self, cmd, data):
+
+        t = time.time() - self.__start
+
+        if cmd in (MultiWii.API_VERSION, MultiWii.FC_VARIANT, MultiWii.MULTIPLE_MSP) and not self.msp_v2:
+            raise KeyError(cmd)
+
+        if cmd == MultiWii.API_VERSION:
+            return MspMessages.get(cmd).encode([0, 1, 42])
+
+        if cmd == MultiWii.FC_VARIANT:
+            return b'BTFL'
+
+        if cmd == MultiWii.MULTIPLE_MSP:
+            reply = bytearray()
+            for code in data:
+                payload = self.__handle(code, b'')
+                if len(reply) + 1 + len(payload) > self.multiple_msp_size:
+                    break
+                reply += bytes((len(payload),)) + payload
+            return bytes(reply)
+
+        if cmd == MultiWii.SET_RAW_RC:
+            values = MspMessages.decode(cmd, data)[0]
+            self.rc[:len(values)] = values
+            return b''
+
+        if cmd == MultiWii.SET_PID:
+            self.pid = list(data[:30])
+            return b''
+
+        if cmd == MultiWii.SET_WP:
+            values = MspMessages.get(cmd).decode(data)
+            self.waypoints[values[0]] = values
+            return b''
+
+        if cmd == MultiWii.WP:
+            wp_no = data[0] if data else 0
+            values = self.waypoints.get(wp_no, (wp_no, 0, 0, 0, 0, 0, 0))
+            return MspMessages.get(cmd).encode(values)
+
+        message = MspMessages.MESSAGES[cmd]
+
+        if message.attribute is None:
+            return b''
+
+        if cmd == MultiWii.IDENT:
+            values = [230, 3, 0, 0]
+
+        elif cmd == MultiWii.STATUS:
+            values = [2800 + int(50 * math.sin(t)), 0, 0b11111, 1 if self.rc[3] > 1100 else 0, 0]
+
+        elif cmd == MultiWii.RAW_IMU:
+            values = [self.__noise(0, 8), self.__noise(0, 8), self.__noise(512, 8),
+                      int(40 * math.cos(t)) + self.__noise(0, 3), int(30 * math.sin(0.7 * t)) + self.__noise(0, 3),
+                      self.__noise(0, 3), int(200 * math.cos(0.1 * t)), int(200 * math.sin(0.1 * t)), -400]
+
+        elif cmd == MultiWii.ATTITUDE:
+            values = [round(30 * math.sin(t), 1), round(20 * math.cos(0.7 * t), 1), int(t * 10) % 360 - 180]
+
+        elif cmd == MultiWii.ALTITUDE:
+            values = [1000 + int(50 * math.sin(0.2 * t)), int(10 * math.cos(0.2 * t))]
+
+        elif cmd == MultiWii.RC:
+            values = self.rc
+
+        elif cmd == MultiWii.MOTOR:
+            values = [min(2000, self.rc[3] + self.__noise(0, 10)) for _ in range(4)] + [0] * 4
+
+        elif cmd == MultiWii.SERVO:
+            values = [1500] * 8
+
+        elif cmd == MultiWii.PID:
+            values = self.pid
+
+        elif isinstance(message, (MspMessages.MspArrayMessage, MspMessages.MspNamesMessage)):
+            return b''
+
+        else:
+            values = [0] * len(message.fields)
+
+        return message.encode(values)
+
+    def __noise(self, center, amplitude):
+
+        return center + self.random.randint(-amplitude, amplitude)
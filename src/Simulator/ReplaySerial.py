@@ -0,0 +1,166 @@
+import threading
+import time
+
+from src.Multiwii import MultiwiiSettings, MspParser, FlightLog, FlightRecorder
+
+
+# Serial port that answers the MSP requests with the replies of a recorded flight log, so the MultiWii, the servers and
+# the ground station pipeline run against real flight data without a board. Set it as the serial port of the settings
+# (or use settings()).
+#
+# speed is the playback speed: 1.0 replays at real time, N at N times real time. Each request is answered with the
+# last reply of its command recorded at that point of the flight. With speed None the replies of each command are
+# played in order as fast as they are requested, e.g. to load test the server. Commands without recorded replies are
+# answered with an error frame, as the firmware does with the unknown ones. Once the end of the log is reached the
+# replay starts again if loop is True, otherwise the requests are not answered anymore and finished is set.
+
+class ReplaySerial(object):
+
+    def __init__(self, path, speed=1.0, loop=False, timeout=0.01):
+
+        self.port = path
+        self.speed = speed
+        self.loop = loop
+        self.timeout = timeout
+        self.is_open = False
+        self.finished = False
+        self.requests = 0
+        self.replies = 0
+
+        self.log = None
+        self.parser = MspParser.MspParser(b'<')
+
+        self.__replies = {}
+        self.__positions = {}
+        self.__output = bytearray()
+        self.__condition = threading.Condition()
+        self.__start = None
+        self.__first = 0
+        self.__last = 0
+
+    def open(self):
+
+        if not self.is_open:
+            self.log = FlightLog.FlightLog(self.port)
+            received = self.log.select(direction=FlightRecorder.IN)
+
+            if len(received):
+                self.__first = int(received['timestamp'][0])
+                self.__last = int(received['timestamp'][-1])
+
+            self.is_open = True
+            self.finished = False
+
+    def close(self):
+
+        if self.is_open:
+            self.is_open = False
+            self.__replies.clear()
+            self.log.close()
+
+    # Returns a settings object whose serial port is the replay
+
+    def settings(self):
+
+        settings = MultiwiiSettings.Settings(self.port)
+        settings.serial_port = self
+        settings.wakeup = 0
+
+        return settings
+
+    @property
+    def in_waiting(self):
+
+        return len(self.__output)
+
+    def write(self, data):
+
+        if not self.is_open:
+            raise ValueError('Replay serial port is not open')
+
+        if self.__start is None:
+            self.__start = time.monotonic()
+
+        replies = []
+
+        for frame in self.parser.feed(data):
+
+            self.requests += 1
+            reply = self.__reply(frame.cmd, frame.version)
+
+            if reply is not None:
+                replies.append(reply)
+
+        if replies:
+            with self.__condition:
+                self.__output += b''.join(replies)
+                self.replies += len(replies)
+                self.__condition.notify_all()
+
+        return len(data)
+
+    # Reads up to size bytes, waits up to timeout seconds if nothing has been replied yet
+
+    def read(self, size=1):
+
+        with self.__condition:
+
+            if not self.__output and self.timeout:
+                self.__condition.wait(self.timeout)
+
+            data = bytes(self.__output[:size])
+            del self.__output[:size]
+
+        return data
+
+    # Replies are framed as the request (MSP v1 or v2)
+
+    def __reply(self, cmd, version):
+
+        replies = self.__replies.get(cmd)
+
+        if replies is None:
+            replies = self.log.select(cmd)
+            self.__replies[cmd] = replies
+
+        if not len(replies):
+            return MspParser.create_frame(cmd, b'', b'!', version)
+
+        row = self.__fast_row(cmd, replies) if self.speed is None else self.__timed_row(replies)
+
+        if row is None:
+            self.finished = True
+            return None
+
+        return MspParser.create_frame(cmd, bytes(self.log.payload(row)), b'>', version)
+
+    # Next reply of the command, in recording order
+
+    def __fast_row(self, cmd, replies):
+
+        position = self.__positions.get(cmd, 0)
+
+        if position >= len(replies):
+            if not self.loop:
+                return None
+            position = 0
+
+        self.__positions[cmd] = position + 1
+
+        return replies[position]
+
+    # Last reply of the command recorded at the current replay time
+
+    def __timed_row(self, replies):
+
+        duration = self.__last - self.__first
+        elapsed = int((time.monotonic() - self.__start) * self.speed * 1000000000)
+
+        if elapsed > duration:
+            if not self.loop:
+                return None
+            elapsed %= duration + 1
+
+        position = replies['timestamp'].searchsorted(self.__first + elapsed, 'right') - 1
+
+        return replies[max(position, 0)]
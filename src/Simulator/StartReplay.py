@@ -0,0 +1,27 @@
+import argparse
+import logging
+
+from src.Multiwii import Logger
+from src.Multiwii.Multiwii import MultiWii
+from src.RaspberryServer.RaspberryServer import RaspberryServer
+from src.Simulator.ReplaySerial import ReplaySerial
+
+parser = argparse.ArgumentParser(description="Runs the RaspberryServer against a recorded flight log")
+parser.add_argument("log", help="flight log written by the flight recorder (.msplog)")
+parser.add_argument("--speed", type=float, default=1.0, help="playback speed, 0 replays as fast as requested")
+parser.add_argument("--loop", action="store_true", help="start again at the end of the log")
+parser.add_argument("--ip", default="0.0.0.0", help="server IP address")
+parser.add_argument("--port", type=int, default=4445, help="server port")
+parser.add_argument("--debug", action="store_true", help="log the (rate limited) per packet messages")
+args = parser.parse_args()
+
+Logger.setup(logging.DEBUG if args.debug else logging.INFO)
+
+replay = ReplaySerial(args.log, args.speed or None, args.loop)
+
+server = RaspberryServer(args.ip, args.port, MultiWii(replay.settings()))
+
+print("Replaying " + args.log)
+
+server.start_server()
+server.start_listening()
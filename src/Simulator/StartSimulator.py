@@ -0,0 +1,12 @@
+import time
+
+from src.Simulator.MultiwiiSimulator import MultiwiiSimulator
+
+simulator = MultiwiiSimulator(latency=0.002)
+simulator.start()
+
+print("MultiWii simulator listening on: " + simulator.port)
+print("Set it as the serial port on MultiwiiSettings to use it")
+
+while True:
+    time.sleep(1)
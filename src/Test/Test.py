@@ -3,6 +3,7 @@ import time
 import _thread
 import struct
 
+from src.Multiwii import MspMessages, TelemetryHistory
 from src.Multiwii.Multiwii import MultiWii
 
 
@@ -221,81 +222,104 @@ class Test:
 
         self.mw.disarm()
 
+    # Telemetry history (needs numpy) around the wrap of its ring buffer: one row less than the capacity, exactly the
+    # capacity and one more. Every kept row is returned, oldest first.
+
+    @staticmethod
+    def test_history_wrap(capacity=3):
+
+        message = MspMessages.get(MultiWii.ALTITUDE)
+
+        for count in (capacity - 1, capacity, capacity + 1):
+
+            history = TelemetryHistory.MessageHistory(message, capacity)
+
+            for i in range(count):
+                history.append(message.snapshot(i, 0, 0, i))
+
+            expected = list(range(max(0, count - capacity), count))
+
+            assert list(history.window()['timestamp']) == expected, history.window()
+            assert list(history.latest()['timestamp']) == expected, history.latest()
+            assert history.stats()['estalt']['count'] == len(expected)
+
+            print("History of %d rows with %d samples: %s" % (capacity, count, expected))
+
     def __print_altitude(self, data):
 
         print("-----ALTITUDE-----\n")
-        print("EstAlt: {} cm".format(data["estalt"]))
-        print("Vario: {} cm/s".format(data["vario"]))
-        print("elapsed: {}".format(data["elapsed"]))
-        print("timestamp: {}".format(data["timestamp"]))
+        print("EstAlt: {} cm".format(data.estalt))
+        print("Vario: {} cm/s".format(data.vario))
+        print("elapsed: {}".format(data.elapsed))
+        print("timestamp: {}".format(data.timestamp))
         print("-------------------\n")
 
     def __print_attitude(self, data):
 
         print("-----ATTITUDE-----\n")
-        print("Angx: {} cm".format(data["angx"]))
-        print("Angy: {} cm/s".format(data["angy"]))
-        print("Heading: {}".format(data["heading"]))
-        print("elapsed: {}".format(data["elapsed"]))
-        print("timestamp: {}".format(data["timestamp"]))
+        print("Angx: {} cm".format(data.angx))
+        print("Angy: {} cm/s".format(data.angy))
+        print("Heading: {}".format(data.heading))
+        print("elapsed: {}".format(data.elapsed))
+        print("timestamp: {}".format(data.timestamp))
         print("-------------------\n")
 
     def __print_raw_imu(self, data):
 
         print("-----RAW_IMU-----")
-        print("accx: {} ,".format(data["accx"]))
-        print("accy: {} ,".format(data["accy"]))
-        print("accz: {} ,".format(data["accz"]))
-        print("gyrx: {} ,".format(data["gyrx"]))
-        print("gyry: {} ,".format(data["gyry"]))
-        print("gyrz: {} ".format(data["gyrz"]))
+        print("accx: {} ,".format(data.accx))
+        print("accy: {} ,".format(data.accy))
+        print("accz: {} ,".format(data.accz))
+        print("gyrx: {} ,".format(data.gyrx))
+        print("gyry: {} ,".format(data.gyry))
+        print("gyrz: {} ".format(data.gyrz))
         print("-------------------\n")
 
     def __print_pid_coef(self, data):
 
         print("-----PID_COEF-----")
-        print("Rp: {} ,".format(data["rp"]))
-        print("Ri: {} ,".format(data["ri"]))
-        print("Rd: {} ,".format(data["rd"]))
-        print("Pp: {} ,".format(data["pp"]))
-        print("Pi: {} ,".format(data["pi"]))
-        print("Pd: {} ,".format(data["pd"]))
-        print("Yp: {} ,".format(data["yp"]))
-        print("Yi: {} ,".format(data["yi"]))
-        print("Yd: {} ,".format(data["yd"]))
-        print("Elapsed: {} ,".format(data["elapsed"]))
-        print("Timestamp: {} ,".format(data["timestamp"]))
+        print("Rp: {} ,".format(data.rp))
+        print("Ri: {} ,".format(data.ri))
+        print("Rd: {} ,".format(data.rd))
+        print("Pp: {} ,".format(data.pp))
+        print("Pi: {} ,".format(data.pi))
+        print("Pd: {} ,".format(data.pd))
+        print("Yp: {} ,".format(data.yp))
+        print("Yi: {} ,".format(data.yi))
+        print("Yd: {} ,".format(data.yd))
+        print("Elapsed: {} ,".format(data.elapsed))
+        print("Timestamp: {} ,".format(data.timestamp))
         print("-------------------\n")
 
     def __print_motor(self, data):
 
         print("-----MOTORS-----")
-        print("M1: {} ,".format(data["m1"]))
-        print("M2: {} ,".format(data["m2"]))
-        print("M3: {} ,".format(data["m3"]))
-        print("M4: {} ,".format(data["m4"]))
-        print("Elapsed: {} ,".format(data["elapsed"]))
-        print("Timestamp: {} ,".format(data["timestamp"]))
+        print("M1: {} ,".format(data.m1))
+        print("M2: {} ,".format(data.m2))
+        print("M3: {} ,".format(data.m3))
+        print("M4: {} ,".format(data.m4))
+        print("Elapsed: {} ,".format(data.elapsed))
+        print("Timestamp: {} ,".format(data.timestamp))
         print("-------------------\n")
 
     def __print_servo(self, data):
 
         print("-----SERVOS-----")
-        print("S1: {} ,".format(data["s1"]))
-        print("S2: {} ,".format(data["s2"]))
-        print("S3: {} ,".format(data["s3"]))
-        print("S4: {} ,".format(data["s4"]))
-        print("Elapsed: {} ,".format(data["elapsed"]))
-        print("Timestamp: {} ,".format(data["timestamp"]))
+        print("S1: {} ,".format(data.s1))
+        print("S2: {} ,".format(data.s2))
+        print("S3: {} ,".format(data.s3))
+        print("S4: {} ,".format(data.s4))
+        print("Elapsed: {} ,".format(data.elapsed))
+        print("Timestamp: {} ,".format(data.timestamp))
         print("-------------------\n")
 
     def __print_rc(self, data):
 
         print("-----RC-----\n")
-        print("Roll: {}".format(data["roll"]))
-        print("Pitch: {}".format(data["pitch"]))
-        print("Yaw: {}".format(data["yaw"]))
-        print("Throttle: {}".format(data["throttle"]))
+        print("Roll: {}".format(data.roll))
+        print("Pitch: {}".format(data.pitch))
+        print("Yaw: {}".format(data.yaw))
+        print("Throttle: {}".format(data.throttle))
         print("-------------------\n")
 
 